@@ -0,0 +1,356 @@
+"""Measures how fast the demo's main stages run without needing an API key or real captures. Synthetic BayseFlow files
+   are enriched against the mock server in mockserver.py (first with an empty cache, then with a warm in-memory cache,
+   then with only the on-disk cache), the cache layer and directory scanning are timed on their own, and interpret
+   requests are run through the adaptive polling. Each run is appended as one JSON line to a results file so that
+   runs can be compared over time, and the last run with the same settings is shown alongside the new one.
+
+   Example: `python3 bench.py --flows 100000 --destinations 2000 --latency 0.02 --label baseline`
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BAYSE_API_KEY", "bench")  # the mock server doesn't check it
+import config
+import interpret
+import kbstore
+import knowledgebase as kb
+import metrics
+import mockserver
+import serializer
+
+DEFAULT_RESULTS_FILENAME = "bench_results.jsonl"
+BENCHMARKS = ["enrich", "cache", "scan", "interpret"]
+PROTOCOLS = ["TCP"] * 8 + ["UDP"] * 2 + ["ICMP"]  # roughly the mix seen in real captures
+PORTS = [443, 443, 443, 80, 53, 123, 8080, 8443]
+
+
+def point_config_at(url):
+    """Sends every API call to `url` (i.e. the mock server) for the rest of the run.
+    """
+    config.BAYSE_API_ENDPOINT = url
+    config.BAYSE_KB_API_URL = f"{url}/destinations"
+    config.BAYSE_KB_BATCH_API_URL = f"{config.BAYSE_KB_API_URL}/batch"
+    config.BAYSE_INTERPRET_API_URL = f"{url}/site/interpret"
+    config.SUBMIT_SITE_TO_INTERPRET = f"{config.BAYSE_INTERPRET_API_URL}/request"
+    config.GET_INTERPRET_STATUS = f"{config.BAYSE_INTERPRET_API_URL}/status?request_id="
+
+
+@contextlib.contextmanager
+def quietly():
+    """Hides everything printed inside the `with` block, so progress messages don't drown out the results.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def make_destinations(count, private_fraction, rng):
+    """Returns `count` unique (dst, protocol, destinationNameSource) tuples, `private_fraction` of which are private
+       addresses. Public destinations are a mix of hostnames (as passive DNS would name them) and public addresses.
+    """
+    destinations = []
+    for index in range(count):
+        protocol = rng.choice(PROTOCOLS)
+        if rng.random() < private_fraction:
+            name, source = f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}", "original"
+        elif rng.random() < 0.7:
+            name, source = f"host{index}.bench{index % 97}.example", "passive"
+        else:
+            name, source = f"198.{index >> 16 & 255 | 64}.{index >> 8 & 255}.{index & 255}", "original"
+        dst = name if protocol == "ICMP" else f"{name}:{rng.choice(PORTS)}"
+        destinations += [(dst, protocol, source)]
+    return destinations
+
+
+def generate_bayseflow_file(fname, flows, destinations, rng):
+    """Writes a labeled (but not yet enriched) BayseFlow file with `flows` flows, each to a destination picked at
+       random from `destinations`.
+    """
+    bayseflows = []
+    for index in range(flows):
+        dst, protocol, source = rng.choice(destinations)
+        bayseflows += [{"src": f"10.0.{index >> 8 & 255}.{index & 255}:{1024 + index % 60000}", "dst": dst,
+                        "destinationNameSource": source, "srcPkts": rng.randint(1, 50),
+                        "srcBytes": rng.randint(40, 50000), "dstPkts": rng.randint(1, 50),
+                        "dstBytes": rng.randint(40, 500000), "relativeStart": round(index * 0.01, 6),
+                        "protocolInformation": protocol, "identifier": str(index),
+                        "duration": round(rng.random() * 60, 6), "label": "benchLabel"}]
+    with open(fname, "w", encoding="utf-8") as f:
+        json.dump({"hash": f"{rng.getrandbits(128):032x}", "trafficDate": "1600000000.0",
+                   "fileName": os.path.basename(fname), "BayseFlows": bayseflows}, f)
+
+
+def generate_bayseflow_files(directory, files, flows, destinations, private_fraction, seed):
+    """Fills `directory` with `files` BayseFlow files of `flows` flows each, drawn from one shared pool of
+       `destinations` destinations.
+    """
+    rng = random.Random(seed)
+    pool = make_destinations(destinations, private_fraction, rng)
+    os.makedirs(directory, exist_ok=True)
+    for index in range(files):
+        generate_bayseflow_file(os.path.join(directory, f"bench{index}.bf"), flows, pool, rng)
+
+
+def get_fresh_store_path(workdir, filename):
+    """Returns the path for a benchmark's store in `workdir`, first deleting any store (and its SQLite journal files)
+       left there by an earlier run with the same --workdir, so that every run starts with an empty store.
+    """
+    path = os.path.join(workdir, filename)
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + suffix)
+    return path
+
+
+def get_counters(snapshot, *names):
+    return {name: snapshot["counters"].get(name, 0) for name in names}
+
+
+def bench_enrich(args, workdir, mock):
+    """Times add_knowledge_for_files_in_dir three times over the same files: with empty caches, with the in-memory
+       cache warm, and with only the on-disk cache warm (as a later run would see it).
+    """
+    flows_dir = os.path.join(workdir, "flows")
+    total_flows = args.files * args.flows
+    kb.STORE = kbstore.DestinationStore(path=get_fresh_store_path(workdir, "bench.sqlite3"))
+    kb.MEMORY_CACHE.clear()
+    kb.MISSING_CACHE.clear()
+    results = dict()
+    for phase in ["cold", "warm_memory", "warm_store"]:
+        if phase == "warm_store":
+            kb.MEMORY_CACHE.clear()
+            kb.MISSING_CACHE.clear()
+        # enrichment rewrites the files in place, so every phase starts again from the same unenriched files
+        generate_bayseflow_files(flows_dir, args.files, args.flows, args.destinations, args.privatefraction,
+                                 args.seed)
+        metrics.METRICS.reset()
+        requests_before = dict(mock.counts)
+        start = time.perf_counter()
+        with quietly():
+            kb.add_knowledge_for_files_in_dir(flows_dir, workers=args.kbworkers, batch_size=args.kbbatchsize)
+        elapsed = time.perf_counter() - start
+        snapshot = metrics.METRICS.snapshot()
+        results[phase] = {"seconds": elapsed, "flows_per_second": total_flows / elapsed,
+                          "stages": {name: stage["seconds"] for name, stage in snapshot["stages"].items()},
+                          "counters": get_counters(snapshot, "kb_cache_hits", "kb_cache_misses", "flows_skipped",
+                                                   "kb_http_requests", "kb_batch_http_requests", "bytes_written"),
+                          "mock_requests": {name: mock.counts[name] - requests_before[name]
+                                            for name in ["single", "batch", "errors"]}}
+    kb.STORE.close()
+    kb.STORE = None
+    return results
+
+
+def bench_cache(args, workdir):
+    """Times the cache layer on its own: bulk writes and reads against the on-disk store, and reads and writes
+       against the in-memory cache.
+    """
+    entries = args.destinations
+    kb_data = mockserver.make_kb_data("host.bench.example", "TCP", 443)
+    keys = [(f"host{index}.bench.example", "TCP", 443) for index in range(entries)]
+    store = kbstore.DestinationStore(path=get_fresh_store_path(workdir, "cache.sqlite3"))
+    results = dict()
+    start = time.perf_counter()
+    store.put_many({key: kb_data for key in keys}, kb.CACHE_EXPIRATION_AS_FLOAT_SECONDS)
+    results["store_put_many"] = time.perf_counter() - start
+    start = time.perf_counter()
+    found = store.get_many(keys)
+    results["store_get_many"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for key in keys[:1000]:
+        store.get(key)
+    results["store_get_1000"] = time.perf_counter() - start
+    store.close()
+    memory_cache = kb.MemoryCache(max_entries=entries)
+    start = time.perf_counter()
+    for key in keys:
+        memory_cache.put(key, kb_data)
+    results["memory_put"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for key in keys:
+        memory_cache.get(key)
+    results["memory_get"] = time.perf_counter() - start
+    return {"entries": entries, "found": len(found),
+            "seconds": results, "store_gets_per_second": entries / results["store_get_many"]}
+
+
+def bench_scan(args, workdir):
+    """Times collect_all_valid_at_level over a tree of Zeek log directories, one directory at a time, and the
+       parallel walk that the demo uses.
+    """
+    import demo  # only needed here, and it pulls in the converter
+    root = os.path.join(workdir, "inputs")
+    directories = []
+    for index in range(args.scandirs):
+        directory = os.path.join(root, f"site{index % 10}", "2023", f"{index // 240 % 12 + 1:02}",
+                                 f"{index // 24 % 10:02}", f"{index % 24:02}")
+        os.makedirs(directory, exist_ok=True)
+        for log in ["conn", "dns"]:
+            open(os.path.join(directory, f"{log}.00:00:00-01:00:00.log"), "w").close()
+        directories += [directory]
+    start = time.perf_counter()
+    for directory in directories:
+        demo.collect_all_valid_at_level(directory)
+    sequential = time.perf_counter() - start
+    start = time.perf_counter()
+    with quietly():
+        jobs = list(demo.walk_all_inputs(root, os.path.join(workdir, "scan_outputs"), args.scanworkers))
+    walk = time.perf_counter() - start
+    return {"directories": len(directories), "jobs": len(jobs), "collect_all_valid_at_level_seconds": sequential,
+            "walk_all_inputs_seconds": walk, "directories_per_second": len(directories) / walk}
+
+
+def bench_interpret(args, workdir, mock):
+    """Times a single interpret_url (submission and polling only) and a batch of interpret requests (including
+       downloading results).
+    """
+    metrics.METRICS.reset()
+    start = time.perf_counter()
+    with quietly():
+        interpret.interpret_url("https://single.bench.example/")
+    single = time.perf_counter() - start
+    single_polls = metrics.METRICS.snapshot()["counters"].get("interpret_status_polls", 0)
+    urls = [f"https://site{index}.bench.example/" for index in range(args.interprets)]
+    metrics.METRICS.reset()
+    start = time.perf_counter()
+    with quietly():
+        statuses = interpret.interpret_urls(urls, screenshot=True, workers=args.interpretworkers,
+                                            output_directory=os.path.join(workdir, "interpret"))
+    batch = time.perf_counter() - start
+    snapshot = metrics.METRICS.snapshot()
+    return {"interpret_seconds": args.interpretseconds,
+            "single_seconds": single, "single_overhead_seconds": single - args.interpretseconds,
+            "single_status_polls": single_polls,
+            "batch_urls": len(urls), "batch_seconds": batch, "batch_urls_per_second": len(urls) / batch,
+            "batch_completed": sum(1 for status in statuses.values() if status == interpret.STATUS_COMPLETE),
+            "batch_counters": get_counters(snapshot, "interpret_status_polls", "interpret_bytes_downloaded")}
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_previous_result(fname, settings):
+    """Returns the most recent result in the results file that was run with the same settings (or None).
+    """
+    previous = None
+    try:
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get("settings") == settings:
+                    previous = result
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def summarize(result):
+    """Returns the headline numbers of a result as {name: (value, unit)}.
+    """
+    summary = dict()
+    benchmarks = result["benchmarks"]
+    if "enrich" in benchmarks:
+        for phase, data in benchmarks["enrich"].items():
+            summary[f"enrich {phase}"] = (data["flows_per_second"], "flows/s")
+    if "cache" in benchmarks:
+        summary["store get_many"] = (benchmarks["cache"]["store_gets_per_second"], "gets/s")
+    if "scan" in benchmarks:
+        summary["walk_all_inputs"] = (benchmarks["scan"]["directories_per_second"], "dirs/s")
+    if "interpret" in benchmarks:
+        summary["interpret single overhead"] = (benchmarks["interpret"]["single_overhead_seconds"], "s")
+        summary["interpret batch"] = (benchmarks["interpret"]["batch_urls_per_second"], "urls/s")
+    return summary
+
+
+def print_summary(result, previous):
+    print(f"{'=' * 30} Benchmark results ({result['label'] or 'unlabeled'}, {result['commit']}) {'=' * 30}")
+    before = summarize(previous) if previous else dict()
+    for name, (value, unit) in summarize(result).items():
+        line = f"  {name:<32}{value:>14.2f} {unit}"
+        if name in before and before[name][0]:
+            line += f"   (was {before[name][0]:0.2f} in {previous['label'] or previous['commit']}, " \
+                    f"{(value - before[name][0]) / before[name][0]:+0.1%})"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the demo against synthetic data and a mock Bayse API.")
+    parser.add_argument("--benchmarks", help="which benchmarks to run", nargs="+", choices=BENCHMARKS,
+                        default=BENCHMARKS)
+    parser.add_argument("--files", help="number of synthetic BayseFlow files to enrich", type=int, default=4)
+    parser.add_argument("--flows", help="number of flows in each synthetic BayseFlow file", type=int, default=25000)
+    parser.add_argument("--destinations", help="number of unique destinations across all flows", type=int,
+                        default=1000)
+    parser.add_argument("--privatefraction", help="fraction of destinations that are private addresses", type=float,
+                        default=0.2)
+    parser.add_argument("--latency", help="seconds of latency the mock server adds to every request", type=float,
+                        default=0.01)
+    parser.add_argument("--errorrate", help="fraction of mock server requests that fail with a 503", type=float,
+                        default=0.0)
+    parser.add_argument("--unknownrate", help="fraction of destinations with no KB data", type=float, default=0.1)
+    parser.add_argument("--kbworkers", help="number of Destination Knowledgebase lookups to run concurrently", type=int,
+                        default=kb.DEFAULT_KB_WORKERS)
+    parser.add_argument("--kbbatchsize", help="number of destinations sent in each batch query", type=int,
+                        default=kb.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--scandirs", help="number of input directories to scan", type=int, default=1000)
+    parser.add_argument("--scanworkers", help="number of directories to scan at once", type=int, default=8)
+    parser.add_argument("--interprets", help="number of URLs to interpret in the batch benchmark", type=int,
+                        default=20)
+    parser.add_argument("--interpretworkers", help="number of interpret requests to work on at once", type=int,
+                        default=interpret.DEFAULT_INTERPRET_WORKERS)
+    parser.add_argument("--interpretseconds", help="seconds the mock server takes to complete an interpret request",
+                        type=float, default=2.0)
+    parser.add_argument("--seed", help="seed for the synthetic data", type=int, default=1)
+    parser.add_argument("--label", help="a name for this run, shown when comparing runs", type=str, default=None)
+    parser.add_argument("--results", help="file that results are appended to as JSON lines", type=str,
+                        default=DEFAULT_RESULTS_FILENAME)
+    parser.add_argument("--workdir", help="directory for generated data (a temporary directory by default)",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    settings = {name: value for name, value in vars(args).items() if name not in ("label", "results", "workdir")}
+    result = {"timestamp": time.time(), "label": args.label, "commit": get_git_commit(),
+              "python": platform.python_version(), "json_backend": serializer.BACKEND, "settings": settings,
+              "benchmarks": dict()}
+    with contextlib.ExitStack() as stack:
+        if args.workdir:
+            workdir = args.workdir
+            os.makedirs(workdir, exist_ok=True)
+        else:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="bayse_bench_"))
+        mock = stack.enter_context(mockserver.MockBayseServer(latency=args.latency, error_rate=args.errorrate,
+                                                              unknown_rate=args.unknownrate,
+                                                              interpret_seconds=args.interpretseconds,
+                                                              seed=args.seed))
+        point_config_at(mock.url)
+        for name in args.benchmarks:
+            print(f"Running the {name} benchmark...", file=sys.stderr)
+            if name == "enrich":
+                result["benchmarks"][name] = bench_enrich(args, workdir, mock)
+            elif name == "cache":
+                result["benchmarks"][name] = bench_cache(args, workdir)
+            elif name == "scan":
+                result["benchmarks"][name] = bench_scan(args, workdir)
+            else:
+                result["benchmarks"][name] = bench_interpret(args, workdir, mock)
+    previous = load_previous_result(args.results, settings)
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    print_summary(result, previous)
+    print(f"Saved results to {args.results}")
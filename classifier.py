@@ -0,0 +1,124 @@
+from bisect import bisect_right
+import config
+import ipaddress
+
+SKIP = "skip"  # the destination is private or internal, so Bayse has nothing to say about it
+QUERY = "query"  # the destination needs to be resolved against the Destination Knowledgebase
+
+# The same ranges that ipaddress treats as private (https://www.iana.org/assignments/iana-ipv4-special-registry/ and
+# https://www.iana.org/assignments/iana-ipv6-special-registry/)
+PRIVATE_CIDRS = [
+    "0.0.0.0/8", "10.0.0.0/8", "127.0.0.0/8", "169.254.0.0/16", "172.16.0.0/12", "192.0.0.0/29", "192.0.0.170/31",
+    "192.0.2.0/24", "192.168.0.0/16", "198.18.0.0/15", "198.51.100.0/24", "203.0.113.0/24", "240.0.0.0/4",
+    "255.255.255.255/32",
+    "::1/128", "::/128", "::ffff:0:0/96", "100::/64", "2001::/23", "2001:2::/48", "2001:db8::/32", "2001:10::/28",
+    "fc00::/7", "fe80::/10"
+]
+MAX_MEMOIZED_DESTINATIONS = 1000000  # the memo is cleared if it ever grows past this many destinations
+
+
+def get_intervals(cidrs):
+    """Merges a list of CIDRs into sorted, non-overlapping (first address, last address) intervals for each IP version,
+       returned as {version: (list of starts, list of ends)} so that an address can be located with a bisect.
+    """
+    intervals = {4: [], 6: []}
+    for cidr in cidrs:
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        intervals[network.version] += [(int(network.network_address), int(network.broadcast_address))]
+    merged = dict()
+    for version, ranges in intervals.items():
+        starts, ends = [], []
+        for start, end in sorted(ranges):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts += [start]
+                ends += [end]
+        merged[version] = (starts, ends)
+    return merged
+
+
+def parse_ipv4(text):
+    """Returns a dotted-quad IPv4 address as an integer, or None if `text` isn't one (e.g. it's a hostname).
+    """
+    parts = text.split(".")
+    if len(parts) != 4:
+        return None
+    value = 0
+    for part in parts:
+        if not part.isdigit() or len(part) > 3 or int(part) > 255:
+            return None
+        value = (value << 8) | int(part)
+    return value
+
+
+def parse_ipv6(text):
+    """Returns an IPv6 address as an integer, or None if `text` isn't one. Only called on text containing a ':',
+       which a hostname never does.
+    """
+    text = text.strip("[]").split("%", 1)[0]  # drop brackets and any zone ID
+    try:
+        return int(ipaddress.IPv6Address(text))
+    except ValueError:
+        return None
+
+
+class DestinationClassifier:
+    """Decides, once per destination, whether a BayseFlow's destination should be skipped (a private or internal
+       address, or a hostname on an internal domain) or queried. Addresses are checked against sorted intervals built
+       from PRIVATE_CIDRS plus `internal_cidrs`, and hostnames are checked against `internal_dns_suffixes` one label at
+       a time. Decisions are memoized, so classifying a flow whose destination has been seen before is a single
+       dictionary lookup.
+    """
+    def __init__(self, internal_cidrs=None, internal_dns_suffixes=None):
+        internal_cidrs = config.INTERNAL_CIDRS if internal_cidrs is None else internal_cidrs
+        internal_dns_suffixes = config.INTERNAL_DNS_SUFFIXES if internal_dns_suffixes is None \
+            else internal_dns_suffixes
+        self.intervals = get_intervals(PRIVATE_CIDRS + list(internal_cidrs))
+        self.internal_suffixes = {suffix.strip(".").lower() for suffix in internal_dns_suffixes if suffix.strip(".")}
+        self.lookup_keys = dict()  # (dst, protocol) -> lookup key, or None if the destination should be skipped
+
+    def _in_intervals(self, version, value):
+        starts, ends = self.intervals[version]
+        index = bisect_right(starts, value) - 1
+        return index >= 0 and value <= ends[index]
+
+    def is_internal(self, destination):
+        """Returns True if `destination` (an IP address or a hostname) is private or internal.
+        """
+        value = parse_ipv4(destination)
+        if value is not None:
+            return self._in_intervals(4, value)
+        if ":" in destination:
+            value = parse_ipv6(destination)
+            return value is not None and self._in_intervals(6, value)
+        labels = destination.rstrip(".").lower().split(".")
+        return any(".".join(labels[index:]) in self.internal_suffixes for index in range(len(labels)))
+
+    def get_lookup_key(self, flow):
+        """Returns the (destination, protocol, port) tuple used to query the Destination Knowledgebase for a
+           BayseFlow, or None if its destination should be skipped.
+        """
+        memo_key = (flow["dst"], flow["protocolInformation"])
+        if memo_key in self.lookup_keys:
+            return self.lookup_keys[memo_key]
+        if flow["protocolInformation"] == "ICMP":
+            dst = flow["dst"]
+            port = None
+        else:
+            dst_data = flow["dst"].split(":")
+            port = int(dst_data[-1])
+            dst = ":".join(dst_data[0:-1])  # handles ipv6 safely
+        lookup_key = None if self.is_internal(dst) else (dst, flow["protocolInformation"], port)
+        if len(self.lookup_keys) >= MAX_MEMOIZED_DESTINATIONS:
+            self.lookup_keys.clear()
+        self.lookup_keys[memo_key] = lookup_key
+        return lookup_key
+
+    def classify(self, flow):
+        """Returns a (decision, lookup key) tuple for a BayseFlow, where the decision is SKIP or QUERY.
+        """
+        lookup_key = self.get_lookup_key(flow)
+        if lookup_key is None:
+            return SKIP, None
+        return QUERY, lookup_key
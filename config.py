@@ -1,10 +1,26 @@
-import sensitive
+import os
 
-API_KEY = sensitive.API_KEY
+try:
+    import sensitive
+    API_KEY = sensitive.API_KEY
+except ImportError:  # allows running against a local mock server (see mockserver.py) without a real key
+    API_KEY = os.environ.get("BAYSE_API_KEY")
 
-BAYSE_API_ENDPOINT = "https://api.bayse.io"
+# Destinations in these CIDRs or DNS domains (comma-separated, e.g. "10.20.0.0/16" or "corp.example.com") are treated as
+# internal, like private addresses, and never sent to the Destination Knowledgebase
+INTERNAL_CIDRS = [cidr.strip() for cidr in os.environ.get("BAYSE_INTERNAL_CIDRS", "").split(",") if cidr.strip()]
+INTERNAL_DNS_SUFFIXES = [suffix.strip() for suffix in os.environ.get("BAYSE_INTERNAL_DNS_SUFFIXES", "").split(",")
+                         if suffix.strip()]
+
+BAYSE_API_ENDPOINT = os.environ.get("BAYSE_API_ENDPOINT", "https://api.bayse.io")
 BAYSE_KB_API_URL = f"{BAYSE_API_ENDPOINT}/destinations"
+BAYSE_KB_BATCH_API_URL = f"{BAYSE_KB_API_URL}/batch"
 BAYSE_INTERPRET_API_URL = f"{BAYSE_API_ENDPOINT}/site/interpret"
 SUBMIT_SITE_TO_INTERPRET = f"{BAYSE_INTERPRET_API_URL}/request"
 GET_INTERPRET_STATUS = f"{BAYSE_INTERPRET_API_URL}/status?request_id="
-LABELING_BINARY_DIR = "labeling/"
\ No newline at end of file
+LABELING_BINARY_DIR = "labeling/"
+
+# Requests per second allowed to the Bayse API across every thread in this process (0 means no limit), and how many
+# requests can be sent at once after a quiet spell
+API_RATE_LIMIT = float(os.environ.get("BAYSE_API_RATE_LIMIT", "0"))
+API_RATE_BURST = int(os.environ.get("BAYSE_API_RATE_BURST", "10"))
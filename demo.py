@@ -1,105 +1,510 @@
 import argparse
 import bayse_summary
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 import config
+import httpclient
 import interpret
 import knowledgebase as kb
+import manifest
+import metrics
+import multiprocessing
+import os
+import queue
+import serializer
+import shutil
+import signal
 import sys
+import tempfile
+import threading
 import time
+import watcher
 from pathlib import Path
 from bayse_tools.converter import convert
 
+DEFAULT_SCAN_WORKERS = 8  # number of directories scanned at once while looking for inputs
+COPY_CHUNK_SIZE = 1048576  # characters copied at a time while compressing a BayseFlow file
+PCAP_EXTENSIONS = [".CAP", ".PCAP", ".PCAPNG"]
+WATCH_QUEUE_SIZE = 64  # inputs (and BayseFlow files) that may wait on the next stage before the one feeding it blocks
+WATCH_TICK_SECONDS = 1.0  # how often watch mode's loops wake up to check whether they should stop
+WATCH_REENRICH_SECONDS = 60.0  # how often watch mode looks for BayseFlow files whose Bayse knowledge has expired
+WORKER_START_METHOD = "forkserver"  # how conversion workers are started where the platform supports it (see below)
 
 
-def convert_and_label_files(connlogs, dnslogs, pcaps, outdir, timing=False, noupload=False):
-    """Takes a set of zero or more conn.log files and dns.log files, converts them into their BayseFlow format,
-       and labels them. The labeling functionality will also upload their stats to the cloud.
+def convert_and_label_file(kind, location, dnslog, outdir, timing=False, share=True, compression=None):
+    """Converts and labels a single input (a Zeek conn.log, with an optional dns.log, or a PCAP). This runs in a worker
+       process, so any failure is caught and returned rather than raised, which keeps one bad file from stopping the
+       rest. The converter writes into a private staging directory whose contents are then moved into `outdir`, so we
+       know exactly which BayseFlow files this input produced even when several conversions share `outdir`. Returns
+       the input's location, how long it took, the error (or None if it succeeded), and the BayseFlow files produced.
+       If `compression` ("gz" or "zst") is given, BayseFlow files are compressed before they are moved into `outdir`.
     """
-    share = not noupload
-    combinedlogs = None
-    if dnslogs:
-        combinedlogs = dict(zip(connlogs, dnslogs))
-    if combinedlogs:
-        for log in combinedlogs:
-            if timing:
-                start_time = time.perf_counter()
-            else:
-                start_time = None
-            print(f"Converting {log}")
-            convert.convert_zeek(log, zeek_dnsfile_location=combinedlogs[log], output_dir=outdir, should_label=True,
+    start_time = time.perf_counter()
+    converter_start = start_time if timing else None
+    error = None
+    bayseflow_files = []
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=outdir)
+    try:
+        if kind == "zeek":
+            convert.convert_zeek(location, zeek_dnsfile_location=dnslog, output_dir=staging_dir, should_label=True,
                                  api_key=config.API_KEY, labeling_path=config.LABELING_BINARY_DIR,
-                                 converter_start=start_time, share_stats=share)
+                                 converter_start=converter_start, share_stats=share)
+        else:
+            convert.convert_pcap(location, output_dir=staging_dir, should_label=True, api_key=config.API_KEY,
+                                 labeling_path=config.LABELING_BINARY_DIR, converter_start=converter_start,
+                                 share_stats=share)
+        for f in Path(staging_dir).iterdir():
+            if compression and f.name.endswith(".bf"):
+                f = compress_bayseflow_file(f, compression)
+            destination = Path(outdir, f.name)
+            os.replace(f, destination)
+            if serializer.is_bayseflow_file(destination.name):
+                bayseflow_files += [str(destination)]
+    except (Exception, SystemExit) as e:  # the converter exits on some invalid inputs
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return location, time.perf_counter() - start_time, error, bayseflow_files
+
+
+def compress_bayseflow_file(fname, compression):
+    """Compresses a BayseFlow file into a file next to it (e.g. `x.bf` into `x.bf.gz`) and removes the original.
+       Returns the path of the compressed file.
+    """
+    compressed = Path(f"{fname}{serializer.COMPRESSION_SUFFIXES[compression]}")
+    with open(fname, 'r', encoding='utf-8') as infile, serializer.open_text(compressed, 'w') as outfile:
+        shutil.copyfileobj(infile, outfile, COPY_CHUNK_SIZE)
+    os.unlink(fname)
+    return compressed
+
+
+def get_conversion_jobs(connlogs, dnslogs, pcaps, outdir):
+    """Builds the list of (kind, location, dnslog, outdir) inputs that need to be converted and labeled. `dnslogs`, if
+       given, lines up with `connlogs` (with None wherever a conn.log has no matching dns.log).
+    """
+    jobs = []
+    if dnslogs:
+        for log, dnslog in zip(connlogs, dnslogs):
+            jobs += [("zeek", log, dnslog, outdir)]
     else:
         for log in connlogs:
-            if timing:
-                start_time = time.perf_counter()
-            else:
-                start_time = None
-            convert.convert_zeek(log, output_dir=outdir, should_label=True, api_key=config.API_KEY,
-                                 labeling_path=config.LABELING_BINARY_DIR, converter_start=start_time,
-                                 share_stats=share)
+            jobs += [("zeek", log, None, outdir)]
     if pcaps:
         for pcap in pcaps:
-            print(f"Converting {pcap}")
-            if timing:
-                start_time = time.perf_counter()
-            else:
-                start_time = None
-            convert.convert_pcap(pcap, output_dir=outdir, should_label=True, api_key=config.API_KEY,
-                                 labeling_path=config.LABELING_BINARY_DIR, converter_start=start_time,
-                                 share_stats=share)
+            jobs += [("pcap", pcap, None, outdir)]
+    return jobs
 
 
+def get_worker_context():
+    """Returns the multiprocessing context that conversion workers are started with. Workers are created while other
+       threads (the enricher, the directory scanners, watch mode's converter) are running, and a plain fork copies any
+       lock those threads hold at that moment into the child, where nothing will ever release it. A fork server is a
+       fresh single-threaded process that workers are forked from instead, so it's used wherever the platform has one
+       (elsewhere the default is spawn, which is just as safe).
+    """
+    if WORKER_START_METHOD in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context(WORKER_START_METHOD)
+    return multiprocessing.get_context()
 
 
-def process_all_inputs(current_directory, output_directory, timing, noupload=False):
+def convert_and_label_jobs(jobs, timing=False, noupload=False, workers=1, on_bayseflow_file=None, on_converted=None,
+                           compression=None, worker_initializer=None, on_finished=None):
+    """Converts and labels every (kind, location, dnslog, outdir) job as it arrives from `jobs`, which may be a
+       generator that is still discovering inputs (and may yield None when it has nothing new yet, so that finished
+       conversions are reported in the meantime). With more than one worker, jobs are spread across a pool of
+       processes, each started by calling `worker_initializer` if it is given, and no more than two per worker are
+       queued at once so that discovery never runs far ahead of conversion. If `on_bayseflow_file` is given, it is
+       called with the path of each BayseFlow file as soon as the input that produced it is done, and `on_converted` is
+       called with each successfully converted input and the BayseFlow files it produced. `on_finished` is called with
+       every input once its conversion has been reported, whether or not it succeeded. BayseFlow files are compressed
+       with `compression` if it is given. Returns the number of inputs that failed.
+    """
+    share = not noupload
+    start_time = time.perf_counter()
+    progress = {"submitted": 0, "completed": 0, "failures": 0}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=worker_initializer,
+                                 mp_context=get_worker_context()) as executor:
+            in_flight = dict()
+            for job in jobs:
+                if job is not None:
+                    kind, location, dnslog, outdir = job
+                    in_flight[executor.submit(convert_and_label_file, kind, location, dnslog, outdir, timing,
+                                              share, compression)] = location
+                    progress["submitted"] += 1
+                # report whatever has finished, only waiting once two jobs per worker are queued
+                done, _ = wait(in_flight, timeout=None if len(in_flight) >= workers * 2 else 0,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect_conversion(future, in_flight.pop(future), progress, timing, on_bayseflow_file,
+                                       on_converted, on_finished)
+            for future in as_completed(list(in_flight)):
+                collect_conversion(future, in_flight.pop(future), progress, timing, on_bayseflow_file,
+                                   on_converted, on_finished)
+    else:
+        for job in jobs:
+            if job is None:
+                continue
+            kind, location, dnslog, outdir = job
+            progress["submitted"] += 1
+            result = convert_and_label_file(kind, location, dnslog, outdir, timing, share, compression)
+            report_conversion(result, progress, timing, on_bayseflow_file, on_converted, on_finished)
+    if timing and progress["submitted"]:
+        print(f"Converted and labeled {progress['completed'] - progress['failures']} of {progress['submitted']} "
+              f"inputs in {time.perf_counter() - start_time:0.1f}s using {max(workers, 1)} worker(s)")
+    return progress["failures"]
+
+
+def collect_conversion(future, location, progress, timing=False, on_bayseflow_file=None, on_converted=None,
+                       on_finished=None):
+    """Gets the result of a conversion that ran in the process pool and reports on it.
+    """
+    try:
+        result = future.result()
+    except Exception as e:  # e.g. the worker process died
+        result = (location, None, f"{type(e).__name__}: {e}", [])
+    report_conversion(result, progress, timing, on_bayseflow_file, on_converted, on_finished)
+
+
+def report_conversion(result, progress, timing=False, on_bayseflow_file=None, on_converted=None, on_finished=None):
+    """Prints the progress line for a finished conversion, updates the progress counters, and hands off any BayseFlow
+       files it produced.
+    """
+    location, elapsed, error, bayseflow_files = result
+    progress["completed"] += 1
+    if elapsed is not None:
+        metrics.add_stage_time("convert_and_label", elapsed)
+    metrics.increment("inputs_failed" if error else "inputs_converted")
+    metrics.increment("bayseflow_files_produced", len(bayseflow_files))
+    if on_converted and not error:
+        on_converted(location, bayseflow_files)
+    if on_bayseflow_file:
+        for bayseflow_file in bayseflow_files:
+            on_bayseflow_file(bayseflow_file)
+    position = f"[{progress['completed']}/{progress['submitted']}]"
+    if error:
+        progress["failures"] += 1
+        print(f"{position} Failed to convert {location}: {error}")
+    elif timing:
+        print(f"{position} Converted and labeled {location} in {elapsed:0.1f}s")
+    else:
+        print(f"{position} Converted and labeled {location}")
+    if on_finished:
+        on_finished(location)
+
+
+def process_all_inputs(current_directory, output_directory, timing, noupload=False, kb_workers=kb.DEFAULT_KB_WORKERS,
+                       kb_batch_size=kb.DEFAULT_BATCH_SIZE, workers=1, scan_workers=DEFAULT_SCAN_WORKERS,
+                       reprocess=False, compact=False, compression=None):
     """Recursively converts, labels, uploads (optionally), and pulls in information from the Bayse knowledgebase for
-       all valid files at the current directory level."""
-    pcaps, connlogs, dnslogs, subdirs = collect_all_valid_at_level(current_directory)
-    print(f"About to process {len(pcaps)} PCAPs and {len(connlogs)} Zeek logs found in {current_directory}")
-    convert_and_label_files(connlogs, dnslogs, pcaps, output_directory, timing, noupload)
-    kb.add_knowledge_for_files_in_dir(output_directory)
+       all valid files in the current directory and its subdirectories. Output files keep the input's directory layout
+       underneath the output directory. Conversion and enrichment run as a pipeline: inputs are converted as soon as
+       the directory walk finds them, and each BayseFlow file is queued for enrichment as soon as it has been produced,
+       so knowledgebase lookups overlap with conversion of the remaining inputs.
+
+       A manifest in the output directory records what earlier runs did. Unless `reprocess` is set, inputs whose
+       contents haven't changed since they were last converted are skipped, and their BayseFlow files are only
+       enriched again once their Bayse knowledge has expired. If `compact` is set, BayseFlow files store each
+       destination's knowledge once rather than in every flow (see kb.add_knowledge_for_file). If `compression` ("gz"
+       or "zst") is given, BayseFlow files are stored compressed, and enrichment reads and writes them that way."""
+    start_time = time.perf_counter()
+    run_manifest = manifest.Manifest(output_directory)
+    bayseflow_queue = queue.Queue()
+    enricher = threading.Thread(target=kb.add_knowledge_for_queued_files, args=(bayseflow_queue,),
+                                kwargs={"workers": kb_workers, "batch_size": kb_batch_size, "compact": compact,
+                                        "on_enriched": lambda fname, fields, seconds: run_manifest.record_enrichment(
+                                            fname, fields.get("hash"), seconds)})
+    enricher.start()
+    try:
+        jobs = walk_all_inputs(current_directory, output_directory, scan_workers)
+        jobs = skip_unchanged_inputs(jobs, run_manifest, bayseflow_queue, reprocess)
+        convert_and_label_jobs(jobs, timing, noupload, workers, on_bayseflow_file=bayseflow_queue.put,
+                               on_converted=run_manifest.record_conversion, compression=compression)
+    finally:
+        bayseflow_queue.put(None)  # tells the enricher there's nothing else coming
+        enricher.join()
+        run_manifest.save()
+        metrics.add_stage_time("total", time.perf_counter() - start_time)
+
+
+def watch_all_inputs(root_directory, output_directory, timing=False, noupload=False, kb_workers=kb.DEFAULT_KB_WORKERS,
+                     kb_batch_size=kb.DEFAULT_BATCH_SIZE, workers=1, compact=False, compression=None,
+                     settle_seconds=watcher.SETTLE_SECONDS, poll_seconds=watcher.POLL_INTERVAL_SECONDS):
+    """Runs as a daemon that converts, labels, uploads (optionally), and enriches inputs under `root_directory` as they
+       show up or change, until it gets Ctrl-C or SIGTERM. It works like process_all_inputs (including the manifest,
+       so inputs that haven't changed are skipped, on startup too), but stays warm between inputs: the converter is
+       only imported once, the conversion worker processes are kept, and so are the Destination KB caches and the
+       HTTP connection pool. A directory is only picked up once every changed input in it has been fully written (see
+       watcher.InputWatcher).
+
+       Each stage hands work to the next through a queue of at most WATCH_QUEUE_SIZE items, so if inputs arrive faster
+       than they can be converted or enriched, the stage feeding the full queue waits rather than piling up work in
+       memory. On shutdown, conversions already underway (and the enrichment of what they produced) are finished,
+       inputs still waiting to be converted are left for the next run, and the manifest is saved. The manifest is also
+       checkpointed while the daemon runs, so even an abrupt stop loses little. Every WATCH_REENRICH_SECONDS, BayseFlow
+       files whose Bayse knowledge has expired (including ones whose lookups partly failed) are enriched again, even if
+       nothing in their directory has changed."""
+    root_directory = os.path.abspath(root_directory)
+    run_manifest = manifest.Manifest(output_directory)
+    job_queue = queue.Queue(maxsize=WATCH_QUEUE_SIZE)
+    bayseflow_queue = queue.Queue(maxsize=WATCH_QUEUE_SIZE)
+    in_progress = set()  # inputs queued or being converted, so they aren't queued again until they've been reported
+    stopping = threading.Event()
+    enricher = threading.Thread(target=kb.add_knowledge_for_queued_files, args=(bayseflow_queue,),
+                                kwargs={"workers": kb_workers, "batch_size": kb_batch_size, "compact": compact,
+                                        "on_enriched": lambda fname, fields, seconds: run_manifest.record_enrichment(
+                                            fname, fields.get("hash"), seconds)})
+    converter = threading.Thread(target=convert_and_label_jobs,
+                                 args=(iter_queued_jobs(job_queue), timing, noupload, workers),
+                                 kwargs={"on_bayseflow_file": bayseflow_queue.put,
+                                         "on_converted": run_manifest.record_conversion, "compression": compression,
+                                         "worker_initializer": ignore_interrupts, "on_finished": in_progress.discard})
+    input_watcher = watcher.InputWatcher(root_directory, is_input_file, exclude=[output_directory],
+                                         settle_seconds=settle_seconds, poll_seconds=poll_seconds)
+    previous_handlers = {signum: signal.signal(signum, lambda *_: stopping.set())
+                         for signum in (signal.SIGINT, signal.SIGTERM)}
+    print(f"Watching {root_directory} for new inputs (using {input_watcher.mode}). Press Ctrl-C to stop.")
+    enricher.start()
+    converter.start()
+    last_reenrich = time.monotonic()
+    try:
+        while not stopping.is_set():
+            if not converter.is_alive() or not enricher.is_alive():
+                print("A processing stage stopped unexpectedly. Shutting down.")
+                break
+            for directory in input_watcher.wait(WATCH_TICK_SECONDS):
+                with metrics.stage("scan_directory"):
+                    pcaps, connlogs, dnslogs, _ = collect_all_valid_at_level(directory)
+                outdir = os.path.normpath(os.path.join(output_directory, os.path.relpath(directory, root_directory)))
+                jobs = [job for job in get_conversion_jobs(connlogs, dnslogs, pcaps, outdir)
+                        if job[1] not in in_progress]  # they'll be checked again the next time they change
+                for job in skip_unchanged_inputs(jobs, run_manifest, bayseflow_queue):
+                    in_progress.add(job[1])
+                    put_unless_stopping(job_queue, job, stopping)
+            if time.monotonic() - last_reenrich >= WATCH_REENRICH_SECONDS:
+                last_reenrich = time.monotonic()
+                for bayseflow_file in run_manifest.claim_expired_outputs(kb.INCOMPLETE_EXPIRATION_SECONDS):
+                    put_unless_stopping(bayseflow_queue, bayseflow_file, stopping)
+            run_manifest.checkpoint()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)  # so a second Ctrl-C stops right away
+        print("Stopping: finishing the inputs being processed now. Press Ctrl-C again to stop immediately.")
+        left_over = 0
+        while not job_queue.empty():
+            job_queue.get_nowait()
+            left_over += 1
+        if left_over:
+            print(f"Left {left_over} queued inputs for the next run")
+        job_queue.put(None)  # tells the converter there's nothing else coming
+        converter.join()
+        bayseflow_queue.put(None)  # and then the enricher
+        enricher.join()
+        input_watcher.close()
+        run_manifest.save()
+
+
+def iter_queued_jobs(job_queue):
+    """Yields conversion jobs from `job_queue` until it gets None, and None every WATCH_TICK_SECONDS in the meantime so
+       that finished conversions are reported even when nothing new is arriving (see convert_and_label_jobs).
+    """
+    while True:
+        try:
+            job = job_queue.get(timeout=WATCH_TICK_SECONDS)
+        except queue.Empty:
+            yield None
+            continue
+        if job is None:
+            return
+        yield job
+
+
+def put_unless_stopping(item_queue, item, stopping):
+    """Puts an item on a bounded queue, waiting for room unless `stopping` is set first. Returns True if it was put.
+    """
+    while not stopping.is_set():
+        try:
+            item_queue.put(item, timeout=WATCH_TICK_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def ignore_interrupts():
+    """Runs in each conversion worker process in watch mode, so that Ctrl-C (which the terminal sends to every process)
+       lets the daemon shut down gracefully rather than killing conversions partway through.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def expand_bayseflow_files(location):
+    """Rewrites every compact BayseFlow file at `location` (a file, or a directory that is searched recursively) in the
+       regular layout.
+    """
+    if Path(location).is_dir():
+        fnames = sorted(Path(root) / name for root, _, names in os.walk(location) for name in names
+                        if serializer.is_bayseflow_file(name))
+    else:
+        fnames = [Path(location)]
+    expanded = 0
+    for fname in fnames:
+        try:
+            if kb.expand_bayseflow_file(fname):
+                expanded += 1
+                print(f"Expanded {fname}")
+        except Exception as e:
+            print(f"Failed to expand {fname}: {e}")
+    print(f"Expanded {expanded} of {len(fnames)} BayseFlow files")
+
+
+def skip_unchanged_inputs(jobs, run_manifest, bayseflow_queue, reprocess=False):
+    """Passes along only the conversion jobs whose inputs are new or have changed since the manifest last saw them (or
+       every job, if `reprocess` is set, so that the manifest still records what they were converted from). For each
+       input that is skipped, its BayseFlow files are queued for enrichment if their Bayse knowledge has expired.
+    """
+    skipped = 0
+    for job in jobs:
+        kind, location, dnslog, outdir = job
+        bayseflow_files = run_manifest.get_unchanged_outputs(location, [location, dnslog], force=reprocess)
+        if bayseflow_files is None:
+            yield job
+            continue
+        skipped += 1
+        for bayseflow_file in bayseflow_files:
+            if run_manifest.needs_enrichment(bayseflow_file):
+                bayseflow_queue.put(bayseflow_file)
+    if skipped:
+        print(f"Skipped {skipped} inputs that haven't changed since they were last converted")
+
+
+def walk_all_inputs(root_directory, output_directory, scan_workers=DEFAULT_SCAN_WORKERS):
+    """Walks `root_directory` and all of its subdirectories, scanning up to `scan_workers` directories at once, and
+       yields a conversion job for each valid input as soon as the directory containing it has been scanned. Each job's
+       output directory mirrors the input's location relative to `root_directory`."""
+    root_directory = os.path.abspath(root_directory)
+    with ThreadPoolExecutor(max_workers=scan_workers) as executor:
+        pending = {executor.submit(scan_directory, root_directory): root_directory}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                try:
+                    pcaps, connlogs, dnslogs, subdirs = future.result()
+                except OSError as e:
+                    print(f"Failed to scan {directory}: {e}")
+                    continue
+                for subdir in subdirs:
+                    pending[executor.submit(scan_directory, subdir)] = subdir
+                if pcaps or connlogs:
+                    print(f"Found {len(pcaps)} PCAPs and {len(connlogs)} Zeek logs in {directory}")
+                outdir = os.path.normpath(os.path.join(output_directory, os.path.relpath(directory, root_directory)))
+                yield from get_conversion_jobs(connlogs, dnslogs, pcaps, outdir)
+
+
+def scan_directory(directory):
+    """Wraps collect_all_valid_at_level so that time spent scanning directories is measured.
+    """
+    with metrics.stage("scan_directory"):
+        pcaps, connlogs, dnslogs, subdirs = collect_all_valid_at_level(directory)
+    metrics.increment("directories_scanned")
+    metrics.increment("inputs_found", len(pcaps) + len(connlogs))
+    return pcaps, connlogs, dnslogs, subdirs
+
+
+def is_input_file(name):
+    return get_zeek_log_type(name) is not None or os.path.splitext(name)[1].upper() in PCAP_EXTENSIONS
+
+
+def get_zeek_log_type(name):
+    """Identifies Zeek conn and dns logs by name and returns ("conn" or "dns", pairing key), or None for any other
+       file. Logs that share a pairing key came from the same Zeek run, e.g. `site1.conn.log` and `site1.dns.log`,
+       or Zeek's rotated `conn.00:00:00-01:00:00.log` and `dns.00:00:00-01:00:00.log`."""
+    for log_type in ["conn", "dns"]:
+        if name.endswith(f"{log_type}.log"):
+            return log_type, name[:-len(f"{log_type}.log")]
+        if name.startswith(f"{log_type}.") and name.endswith(".log"):
+            return log_type, name[len(f"{log_type}."):]
+    return None
 
 
 def collect_all_valid_at_level(directory):
     """Takes a directory and collects all valid input files to be processed at that level. Any subdirectories (that
-       will be processed in a later call of this function) are also captured here."""
+       will be processed in a later call of this function) are also captured here. Every conn.log is paired with the
+       dns.log from the same Zeek run (if there is one), so the returned dnslogs line up with connlogs and hold None
+       wherever a conn.log has no dns.log."""
 
     subdirs_to_process = []
     zeek_files = dict()
     pcap_files = []
-    connlogs = set()
-    dnslogs = set()
-    for f in Path(directory).iterdir():
-        if f.is_file():
-            if f.name.endswith("conn.log"):
-                if f.stem not in zeek_files:
-                    zeek_files[f.stem] = {"conn": None, "dns": None}
-                zeek_files[f.stem]["conn"] = f.absolute()
-            elif f.name.endswith("dns.log"):
-                if f.stem not in zeek_files:
-                    zeek_files[f.stem] = {"conn": None, "dns": None}
-                zeek_files[f.stem]["dns"] = f.absolute()
-            elif f.suffix.upper() in [".CAP", ".PCAP", ".PCAPNG"]:
-                pcap_files += [f.absolute()]
-        elif Path.is_dir(f):
-            subdirs_to_process += [f]
-    for zeek in zeek_files:
-        if zeek_files[zeek]["dns"]:
-            dnslogs.add(zeek_files[zeek]["dns"])
+    connlogs = []
+    dnslogs = []
+    with os.scandir(directory) as entries:
+        for f in entries:
+            if f.is_dir(follow_symlinks=False):  # don't follow links, which could loop back on themselves
+                subdirs_to_process += [os.path.abspath(f.path)]
+            elif f.is_file():
+                zeek_log = get_zeek_log_type(f.name)
+                if zeek_log:
+                    log_type, pairing_key = zeek_log
+                    if pairing_key not in zeek_files:
+                        zeek_files[pairing_key] = {"conn": None, "dns": None}
+                    zeek_files[pairing_key][log_type] = Path(os.path.abspath(f.path))
+                elif os.path.splitext(f.name)[1].upper() in PCAP_EXTENSIONS:
+                    pcap_files += [Path(os.path.abspath(f.path))]
+    for zeek in sorted(zeek_files):
         if zeek_files[zeek]["conn"]:
-            connlogs.add(zeek_files[zeek]["conn"])
-    return pcap_files, connlogs, dnslogs, subdirs_to_process
+            connlogs += [zeek_files[zeek]["conn"]]
+            dnslogs += [zeek_files[zeek]["dns"]]
+    return sorted(pcap_files), connlogs, dnslogs, sorted(subdirs_to_process)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--e2e", help=f"given a directory, perform entire e2e process. Recurses through subdirectories."
                         , type=str, default=None)
+    parser.add_argument("--watch", help="given a directory, keep running and perform the e2e process on inputs as they "
+                                        "appear in it (or its subdirectories)", type=str, default=None)
+    parser.add_argument("--watchsettle", help="seconds an input must go unmodified before --watch picks it up",
+                        type=float, default=watcher.SETTLE_SECONDS)
+    parser.add_argument("--watchinterval", help="seconds between checks for new inputs when --watch can't use inotify",
+                        type=float, default=watcher.POLL_INTERVAL_SECONDS)
     parser.add_argument("--outputdirectory", help="directory where BayseFlow files should be stored", type=str,
                         default="/tmp/bayseflows")
     parser.add_argument("-t", "--timing", help="capture diagnostics about timing of each step", action="store_true")
     parser.add_argument("--noupload", help="add this to avoid processing statistics in the cloud", action="store_true")
+    parser.add_argument("--workers", help="number of input files to convert and label in parallel", type=int,
+                        default=1)
+    parser.add_argument("--scanworkers", help="number of directories to scan at once while looking for inputs",
+                        type=int, default=DEFAULT_SCAN_WORKERS)
+    parser.add_argument("--reprocess", help="convert and enrich every input, even ones that haven't changed since an "
+                                            "earlier run", action="store_true")
+    parser.add_argument("--kbworkers", help="number of Destination Knowledgebase lookups to run concurrently", type=int,
+                        default=kb.DEFAULT_KB_WORKERS)
+    parser.add_argument("--kbbatchsize", help="number of destinations sent in each Destination Knowledgebase batch "
+                                              "query (0 queries each destination on its own)", type=int,
+                        default=kb.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--ratelimit", help="most requests per second sent to the Bayse API, across every worker (0 "
+                                            "means no limit)", type=float, default=config.API_RATE_LIMIT)
+    parser.add_argument("--compact", help="store each destination's Bayse knowledge once per BayseFlow file instead of "
+                                          "in every flow", action="store_true")
+    parser.add_argument("--compress", help="store BayseFlow files compressed (as .bf.gz or .bf.zst)",
+                        choices=list(serializer.COMPRESSION_SUFFIXES), default=None)
+    parser.add_argument("--expand", help="rewrite compact BayseFlow files in this file or directory (recursively) in "
+                                         "the regular layout and exit", type=str, default=None)
+    parser.add_argument("--compactkb", help="remove expired and excess entries from the Destination Knowledgebase "
+                                            "cache and exit", action="store_true")
+    parser.add_argument("--metricsfile", help="write the timing and metrics report to this file as JSON", type=str,
+                        default=None)
     parser.add_argument("--interpret", help=f"a URL or destination that should be interpreted", type=str, default=None)
+    parser.add_argument("--interpretfile", help=f"a file listing URLs or destinations to interpret, one per line",
+                        type=str, default=None)
+    parser.add_argument("--interpretworkers", help="number of interpret requests to work on at once", type=int,
+                        default=interpret.DEFAULT_INTERPRET_WORKERS)
+    parser.add_argument("--interpretdirectory", help="directory where interpret results should be stored", type=str,
+                        default=".")
+    parser.add_argument("--interpretdeadline", help="seconds to wait for interpret results before giving up",
+                        type=float, default=interpret.DEFAULT_INTERPRET_DEADLINE_SECONDS)
     parser.add_argument("-s", "--screenshot", help=f"Should we capture a screenshot of the URL?",
                         action='store_true', default=False)
     parser.add_argument("-d", "--details", help=f"Should we capture the destination details that were found when "
@@ -107,22 +512,61 @@ if __name__ == "__main__":
     parser.add_argument("--url", help=f"The URL where an interpret result is stored."
                         , type=str, default=None)
     args = parser.parse_args()
+    httpclient.set_rate_limit(args.ratelimit)
 
-    if args.e2e:
-        if Path(args.e2e).is_dir():
-            process_all_inputs(args.e2e, args.outputdirectory, args.timing, args.noupload)
-        else:
-            print(f"{args.e2e} is not a directory. Please supply a directory for this argument!")
-        sys.exit()
-    else:
-        if not args.url:
-            if not args.interpret:
-                parser.print_help()
+    try:
+        if args.compactkb:
+            kb.compact_cache()
+            sys.exit()
+        if args.expand:
+            expand_bayseflow_files(args.expand)
+            sys.exit()
+        if args.watch:
+            try:
+                serializer.check_compression(args.compress)
+            except RuntimeError as e:
+                print(e)
+                sys.exit(1)
+            if Path(args.watch).is_dir():
+                watch_all_inputs(args.watch, args.outputdirectory, args.timing, args.noupload, args.kbworkers,
+                                 args.kbbatchsize, args.workers, args.compact, args.compress, args.watchsettle,
+                                 args.watchinterval)
+            else:
+                print(f"{args.watch} is not a directory. Please supply a directory for this argument!")
+            sys.exit()
+        if args.e2e:
+            try:
+                serializer.check_compression(args.compress)
+            except RuntimeError as e:
+                print(e)
                 sys.exit(1)
-            print(f"Sending {args.interpret} to be interpreted")
-            result = interpret.interpret_url(args.interpret, args.screenshot, args.details)
-            interpret.get_interpret_result(result)
+            if Path(args.e2e).is_dir():
+                process_all_inputs(args.e2e, args.outputdirectory, args.timing, args.noupload, args.kbworkers,
+                                   args.kbbatchsize, args.workers, args.scanworkers, args.reprocess, args.compact,
+                                   args.compress)
+            else:
+                print(f"{args.e2e} is not a directory. Please supply a directory for this argument!")
+            sys.exit()
         else:
-            print(f"Ignoring all other args and interpreting passed in URL.")
-            interpret.get_interpret_result(args.url)
-
+            if args.interpretfile:
+                urls = interpret.read_urls_to_interpret(args.interpretfile)
+                print(f"Sending {len(urls)} URLs from {args.interpretfile} to be interpreted")
+                interpret.interpret_urls(urls, args.screenshot, args.details, args.interpretworkers,
+                                         args.interpretdeadline, args.interpretdirectory)
+            elif not args.url:
+                if not args.interpret:
+                    parser.print_help()
+                    sys.exit(1)
+                print(f"Sending {args.interpret} to be interpreted")
+                result = interpret.interpret_url(args.interpret, args.screenshot, args.details,
+                                                 args.interpretdeadline)
+                if result:
+                    interpret.get_interpret_result(result, args.interpretdirectory, args.interpret)
+            else:
+                print(f"Ignoring all other args and interpreting passed in URL.")
+                interpret.get_interpret_result(args.url, args.interpretdirectory)
+    finally:
+        if args.timing:
+            print(metrics.METRICS.report())
+        if args.metricsfile:
+            metrics.METRICS.write_json(args.metricsfile)
@@ -0,0 +1,161 @@
+"""The HTTP client shared by everything that talks to the Bayse API (Destination KB lookups and interpret requests).
+
+   Sessions keep a pool of connections alive for every worker that shares them, give every request a timeout, and
+   retry throttled (429) and transient (5xx or connection) failures with exponential backoff, waiting as long as the
+   server asks to if it sends a Retry-After header. Every session in the process draws from one token bucket so that
+   parallel workers stay within config.API_RATE_LIMIT, and a 429 pauses all of them rather than just the worker that
+   was throttled.
+"""
+import config
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import metrics
+import random
+import requests
+import requests.adapters
+import threading
+import time
+
+DEFAULT_POOL_SIZE = 16  # connections kept alive per host; should match the number of workers sharing a session
+CONNECT_TIMEOUT_SECONDS = 5
+READ_TIMEOUT_SECONDS = 30  # between bytes received, not for the whole response
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5  # doubles with every retry
+RETRY_JITTER = 0.2  # waits are randomly spread by up to this fraction so that workers don't retry in lockstep
+MAX_RETRY_DELAY_SECONDS = 60  # longest we'll wait before a retry, even if the server asks for longer
+THROTTLED_STATUS_CODES = [429, 503]  # the server didn't act on the request, so it's always safe to send again
+RETRY_STATUS_CODES = THROTTLED_STATUS_CODES + [500, 502, 504]
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+
+class TokenBucket:
+    """A thread-safe token bucket that lets `rate` requests per second through on average, and up to `burst` at once
+       after a quiet spell. A rate of 0 lets everything through, except while the bucket is paused.
+    """
+    def __init__(self, rate=0.0, burst=1):
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.burst = max(1, burst if burst is not None else self.burst)
+            self.tokens = float(self.burst)
+            self.updated = time.monotonic()
+
+    def acquire(self):
+        """Blocks until a request is allowed to be sent. Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.paused_until - now
+                if delay <= 0 and self.rate > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                elif delay <= 0:
+                    return waited
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Holds back every request for `seconds` (e.g. because the server said we're being throttled).
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+RATE_LIMITER = TokenBucket(config.API_RATE_LIMIT, config.API_RATE_BURST)  # shared by every session in this process
+
+
+def set_rate_limit(rate, burst=None):
+    """Changes how many requests per second (0 means no limit) every session in this process may send.
+    """
+    RATE_LIMITER.configure(rate, burst)
+
+
+def get_retry_delay(attempt):
+    """Returns how long to wait before retry number `attempt` (starting at 0): exponential backoff with jitter.
+    """
+    delay = min(RETRY_BACKOFF_SECONDS * 2 ** attempt, MAX_RETRY_DELAY_SECONDS)
+    return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+
+def get_retry_after(response):
+    """Returns the number of seconds a response's Retry-After header asks us to wait (capped at
+       MAX_RETRY_DELAY_SECONDS), or None if it doesn't have a usable one.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_DELAY_SECONDS)
+
+
+class Session(requests.Session):
+    """A requests session with a connection pool of `pool_size`, a default timeout, the process-wide rate limiter,
+       and retries. Throttled responses (429 and 503) are retried for any request, since the server didn't act on
+       them; other 5xx responses and connection failures are only retried for idempotent methods, or when the caller
+       passes `idempotent=True` for a POST that is safe to send twice. Once the retries run out, the last response
+       is returned (or the last exception raised) as usual.
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                 timeout=(CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS), limiter=RATE_LIMITER):
+        super().__init__()
+        self.retries = retries
+        self.timeout = timeout
+        self.limiter = limiter
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, idempotent=None, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            waited = self.limiter.acquire()
+            if waited:
+                metrics.observe("http_rate_limit_wait", waited)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt >= self.retries:
+                    raise
+                delay = get_retry_delay(attempt)
+            else:
+                retryable = response.status_code in THROTTLED_STATUS_CODES or \
+                    (idempotent and response.status_code in RETRY_STATUS_CODES)
+                if not retryable or attempt >= self.retries:
+                    return response
+                retry_after = get_retry_after(response)
+                delay = retry_after if retry_after is not None else get_retry_delay(attempt)
+                if response.status_code == 429:
+                    metrics.increment("http_throttled")
+                    self.limiter.pause(delay)
+                response.close()
+            metrics.increment("http_retries")
+            time.sleep(delay)
+            attempt += 1
+
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    """Creates a session whose connection pool is large enough to keep a connection alive for every worker that
+       shares it.
+    """
+    return Session(pool_size)
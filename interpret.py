@@ -1,63 +1,193 @@
 import base64
 import config
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+import heapq
+import httpclient
 import json
-import requests
+from jsonstream import JsonObjectWriter, JsonStreamReader
+import metrics
+import os
+import random
+import re
+import tempfile
 import time
 
 # Constants
 VALID_RESULT_TYPES = ["interpretation", "screenshot", "knowledge", "statistics", "partial_knowledge",
                       "all_destination_details", "iocs"]
 RESULTS_WITH_BINARY_DATA = ["screenshot"]
-TIME_DELAY_SECONDS = 10
+BINARY_FILE_EXTENSIONS = {"screenshot": "png"}
+DOWNLOAD_CHUNK_SIZE = 65536  # bytes written to disk at a time while downloading a result
+MAX_FILENAME_NAME_LENGTH = 100  # characters of an interpreted URL used when naming its result files
+POLL_INITIAL_DELAY_SECONDS = 1.0  # wait before the first status check of a request
+POLL_MAX_DELAY_SECONDS = 30.0
+POLL_BACKOFF_FACTOR = 1.5  # each unfinished status check stretches the wait before the next one by this much
+POLL_JITTER = 0.2  # waits are randomly spread by up to this fraction so that requests don't poll in lockstep
+DEFAULT_INTERPRET_WORKERS = 8
+DEFAULT_INTERPRET_DEADLINE_SECONDS = 1800
+STATUS_COMPLETE = "Complete"
+STATUS_FAILED = "Failed"
+STATUS_TIMED_OUT = "Timed Out"
 
 
-def get_interpret_result(url):
-    """Takes a URL that points to where an interpret result is stored and gets it. If there are screenshots,
-       it will turn them back into the screenshot.
+def get_interpret_result(url, output_directory=".", name=None, session=None):
+    """Takes a URL that points to where an interpret result is stored and saves it to `output_directory`. The download
+       is streamed to disk and then parsed a piece at a time, so a large result never has to fit in memory: any
+       screenshots are decoded a chunk at a time straight into PNG files, and every other part of the result is
+       written to its own JSON file. Files are named after when they were saved and, if given, the `name` of what was
+       interpreted. Returns the list of files saved (or None if the result couldn't be downloaded or parsed).
     """
+    session = session or httpclient.get_session(1)
+    os.makedirs(output_directory, exist_ok=True)
+    download_fd, download_filename = tempfile.mkstemp(prefix=".interpret-", suffix=".json.part", dir=output_directory)
     try:
-        response = requests.get(url)
-    except Exception as e:
-        print(f"Failed to get interpret results from url: {e}")
-        return
-    try:
-        data = response.json()
-        if "results" not in data:
-            print(f"No results.")
+        with os.fdopen(download_fd, "wb") as fout:
+            try:
+                with metrics.stage("interpret_download"), session.get(url, stream=True) as response:
+                    if response.status_code != 200:
+                        print(f"Failed to get interpret results from url: {response.text}")
+                        return None
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        fout.write(chunk)
+                        metrics.increment("interpret_bytes_downloaded", len(chunk))
+            except Exception as e:
+                print(f"Failed to get interpret results from url: {e}")
+                return None
+        time_string = datetime.now().strftime("%Y-%m-%d_%H%M%S.%fZ")
+        prefix = f"{time_string}_{get_safe_filename(name)}" if name else time_string
+        try:
+            with metrics.stage("interpret_save"), open(download_filename, "r", encoding="utf-8") as f:
+                return save_interpret_result(JsonStreamReader(f), output_directory, prefix)
+        except Exception as e:
+            print(f"Failed to parse interpret result as JSON: {e}")
             return None
-        for element in data["results"]:
-            if type(element) != dict:
+    finally:
+        os.unlink(download_filename)
+
+
+def get_safe_filename(name):
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", name).strip("_")[:MAX_FILENAME_NAME_LENGTH]
+
+
+def claim_filename(output_directory, used_filenames, base, extension):
+    """Returns a path in `output_directory` for `base` that hasn't been used for this result yet.
+    """
+    filename = f"{base}.{extension}"
+    count = 1
+    while filename in used_filenames:
+        count += 1
+        filename = f"{base}_{count}.{extension}"
+    used_filenames.add(filename)
+    return os.path.join(output_directory, filename)
+
+
+def save_interpret_result(reader, output_directory, prefix):
+    """Walks a downloaded interpret result with a JsonStreamReader and saves each of its `results` in turn (see
+       save_result_element). Returns the list of files saved.
+    """
+    saved = []
+    used_filenames = set()
+    found_results = False
+    for key in reader.iter_object():
+        if key != "results" or reader.peek() != "[":
+            reader.read_value()
+            continue
+        found_results = True
+        for _ in reader.iter_elements():
+            if reader.peek() != "{":
                 print(f"Failed to get any meaningful results.")
-                return None
-            if element["type"] in VALID_RESULT_TYPES:
-                current_type = element["type"]
-                if current_type in element and element[current_type]:
-                    if current_type in RESULTS_WITH_BINARY_DATA:
-                        print(f"{current_type.upper()}: {element['message']}")
-                        if current_type == "screenshot":
-                            img_data = base64.b64decode(element[current_type])
-                            time_string = datetime.now().strftime("%Y-%m-%d_%H%M%S.%fZ")
-                            filename = f"{time_string}_{current_type}.png"
-                            with open(filename, "wb") as fout:
-                                fout.write(img_data)
-                            print(f"Successfully saved {current_type} to {filename}")
-                    else:
-                        for info in element:
-                            print(f"{info}: {element[info]}")
-                        print(f"{'+' * 80}")
-    except Exception as e:
-        print(f"Failed to parse interpret result as JSON: {e}")
-        return
+                return saved
+            saved += save_result_element(reader, output_directory, prefix, used_filenames)
+    if not found_results:
+        print(f"No results.")
+    return saved
+
+
+def save_result_element(reader, output_directory, prefix, used_filenames):
+    """Saves one element of an interpret result's `results`. Binary members (i.e. screenshots) are base64-decoded as
+       they are read and written to their own files. If the element is a binary result type, that file is the
+       result; otherwise the element is written to a JSON file, with any binary members replaced by the name of the
+       file they were saved to. Elements whose type isn't one we know about, or which are missing their data, are
+       skipped. Returns the list of files saved.
+    """
+    partial_json = claim_filename(output_directory, used_filenames, f".{prefix}", "json.part")
+    binary_files = dict()  # key -> (partial path, final path)
+    has_data = dict()  # key -> whether the member had a (non-empty) value
+    element_type = message = None
+    try:
+        with open(partial_json, "w", encoding="utf-8") as fout:
+            writer = JsonObjectWriter(fout)
+            for key in reader.iter_object():
+                if key in RESULTS_WITH_BINARY_DATA and reader.peek() == '"':
+                    path = claim_filename(output_directory, used_filenames, f"{prefix}_{key}",
+                                          BINARY_FILE_EXTENSIONS.get(key, "bin"))
+                    binary_files[key] = (f"{path}.part", path)
+                    with open(f"{path}.part", "wb") as binary_out:
+                        has_data[key] = decode_base64_chunks(reader.iter_string(), binary_out) > 0
+                    writer.write_member(key, os.path.basename(path))
+                    continue
+                value = reader.read_value()
+                has_data[key] = bool(value)
+                if key == "type":
+                    element_type = value
+                elif key == "message":
+                    message = value
+                writer.write_member(key, value)
+            writer.close()
+        if element_type not in VALID_RESULT_TYPES or not has_data.get(element_type):
+            return []
+        saved = []
+        for partial, path in binary_files.values():
+            os.replace(partial, path)
+            saved += [path]
+        if element_type in RESULTS_WITH_BINARY_DATA:
+            print(f"{element_type.upper()}: {message}")
+            print(f"Successfully saved {element_type} to {binary_files[element_type][1]}")
+            return saved
+        path = claim_filename(output_directory, used_filenames, f"{prefix}_{element_type}", "json")
+        os.replace(partial_json, path)
+        print(f"{element_type.upper()}: {message}")
+        print(f"Successfully saved {element_type} to {path}")
+        return saved + [path]
+    finally:
+        for partial in [partial_json] + [partial for partial, _ in binary_files.values()]:
+            if os.path.exists(partial):
+                os.unlink(partial)
+
+
+def decode_base64_chunks(chunks, fout):
+    """Decodes base64 text that arrives a piece at a time, writing the decoded bytes to `fout` as it goes so that
+       neither the text nor the bytes are ever held in memory all at once. Returns the number of bytes written.
+    """
+    pending = ""
+    written = 0
+    for chunk in chunks:
+        pending += "".join(chunk.split())
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            written += fout.write(base64.b64decode(pending[:usable]))
+            pending = pending[usable:]
+    if pending:
+        written += fout.write(base64.b64decode(pending))
+    return written
+
+
+def get_next_poll_delay(delay):
+    """Returns how long to wait before the next status check of a request that was last checked after waiting
+       `delay` seconds (exponential backoff with jitter, capped at POLL_MAX_DELAY_SECONDS).
+    """
+    return min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY_SECONDS)
+
 
+def jitter(delay):
+    return delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
 
-def interpret_url(url_to_interpret, screenshot=False, all_dest_details=False):
-    """Submits the URL for interpretation and any other requested functionality. Polls for the response and returns
-       the data to the user when received.
+
+def submit_interpret_request(session, url_to_interpret, screenshot=False, all_dest_details=False):
+    """Submits the URL for interpretation and any other requested functionality. Returns the request ID, or None if
+       the submission failed.
     """
-    results = None
-    request_id = None
-    url = config.SUBMIT_SITE_TO_INTERPRET
     payload = json.dumps({
         "url": f"{url_to_interpret}",
         "getScreenshot": screenshot,
@@ -67,46 +197,175 @@ def interpret_url(url_to_interpret, screenshot=False, all_dest_details=False):
         "X-API-KEY": f"{config.API_KEY}",
         "Content-Type": "application/json"
     }
-    response = requests.request("POST", url, headers=headers, data=payload)
+    try:
+        with metrics.stage("interpret_submit"):
+            response = session.request("POST", config.SUBMIT_SITE_TO_INTERPRET, headers=headers, data=payload)
+    except Exception as e:
+        print(f"Error encountered while interpreting {url_to_interpret}: {e}")
+        return None
     if response.status_code != 200:
-        print(f"Failed to interpret URL: {response.text}")
+        print(f"Failed to interpret {url_to_interpret}: {response.text}")
     try:
         data = response.json()
         if "request_id" not in data:
-            print(f"Failed to interpret URL: {response.text}")
-        else:
-            request_id = data["request_id"]
+            print(f"Failed to interpret {url_to_interpret}: {response.text}")
+            return None
+        return data["request_id"]
+    except Exception as e:
+        print(f"Error encountered while interpreting {url_to_interpret}: {e}")
+        return None
+
+
+def get_interpret_status(session, request_id):
+    """Checks on an interpret request. Returns a (status, download link) tuple, where the status is STATUS_COMPLETE,
+       STATUS_FAILED, or None if the request is still in progress. Transient errors (connection failures and 5xx
+       responses) count as still in progress so that the request is checked again later.
+    """
+    url = f"{config.GET_INTERPRET_STATUS}{request_id}"
+    headers = {"X-API-KEY": f"{config.API_KEY}"}
+    poll_start = time.perf_counter()
+    try:
+        response = session.request("GET", url, headers=headers)
+    except Exception as e:
+        print(f"Error encountered while checking interpret request {request_id}: {e}")
+        return None, None
+    finally:
+        metrics.observe("interpret_status_latency", time.perf_counter() - poll_start)
+        metrics.increment("interpret_status_polls")
+    if response.status_code >= 500:
+        return None, None
+    if response.status_code != 200:
+        print(f"Failed to get status for interpret request {request_id}: {response.text}")
+        return STATUS_FAILED, None
+    try:
+        data = response.json()
     except Exception as e:
-        print(f"Error encountered while interpreting URL: {e}")
-    if request_id:
-        url = f"{config.GET_INTERPRET_STATUS}{request_id}"
-        headers = {"X-API-KEY": f"{config.API_KEY}"}
-        payload = {}
-        response = requests.request("GET", url, headers=headers, data=payload)
-        if response.status_code != 200:
-            print(f"Failed to get status for URL: {response.text}")
-        else:
-            failed = False
-            while not results and not failed:
-                time.sleep(TIME_DELAY_SECONDS)
-                response = requests.request("GET", url, headers=headers, data=payload)
-                if response.status_code != 200:
-                    print(f"Failed to get status for URL: {response.text}")
-                    failed = True
+        print(f"Error encountered while checking interpret request {request_id}: {e}")
+        return STATUS_FAILED, None
+    if "status" not in data:
+        print(f"Failed to get status for interpret request {request_id}: {response.text}")
+        return STATUS_FAILED, None
+    if data["status"] == STATUS_FAILED:
+        print(f"Something failed while interpreting request {request_id}.")
+        return STATUS_FAILED, None
+    if data["status"] == STATUS_COMPLETE:
+        return STATUS_COMPLETE, data["download_link"]
+    return None, None  # we're just waiting on an in progress interpretation
+
+
+def interpret_url(url_to_interpret, screenshot=False, all_dest_details=False,
+                  deadline_seconds=DEFAULT_INTERPRET_DEADLINE_SECONDS):
+    """Submits the URL for interpretation and any other requested functionality. Polls for the response (checking
+       quickly at first and then backing off) and returns the download link for the results when received.
+    """
+    session = httpclient.get_session(1)
+    request_id = submit_interpret_request(session, url_to_interpret, screenshot, all_dest_details)
+    if not request_id:
+        return None
+    deadline = time.monotonic() + deadline_seconds
+    delay = POLL_INITIAL_DELAY_SECONDS
+    with metrics.stage("interpret_polling"):
+        while True:
+            time.sleep(max(0.0, min(jitter(delay), deadline - time.monotonic())))
+            status, download_link = get_interpret_status(session, request_id)
+            if status == STATUS_COMPLETE:
+                return download_link
+            if status == STATUS_FAILED:
+                return None
+            if time.monotonic() >= deadline:
+                print(f"Gave up waiting on {url_to_interpret} after {deadline_seconds}s.")
+                return None
+            delay = get_next_poll_delay(delay)
+
+
+def read_urls_to_interpret(filename):
+    """Reads the URLs or destinations to interpret from a file with one per line, skipping blank lines and lines that
+       start with '#'.
+    """
+    with open(filename, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def interpret_urls(urls_to_interpret, screenshot=False, all_dest_details=False, workers=DEFAULT_INTERPRET_WORKERS,
+                   deadline_seconds=DEFAULT_INTERPRET_DEADLINE_SECONDS, output_directory="."):
+    """Interprets many URLs at once. At most `workers` submissions, status checks, and downloads are in flight at any
+       time. Every pending request is tracked by one scheduler that checks on each request with its own exponential
+       backoff (with jitter), and results are downloaded to `output_directory` as soon as each request completes.
+       Requests that haven't completed within `deadline_seconds` of starting are given up on. Returns a dictionary
+       mapping each URL to its final status.
+    """
+    session = httpclient.get_session(workers)
+    deadline = time.monotonic() + deadline_seconds
+    statuses = dict()
+    unsubmitted = list(reversed(list(dict.fromkeys(urls_to_interpret))))
+    schedule = []  # heap of (when to check, tie-breaker, url, request ID, delay used)
+    downloads = []  # (url, download link) ready to fetch
+    in_flight = dict()  # future -> (kind, url, request ID, delay used)
+    sequence = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            now = time.monotonic()
+            expired = now >= deadline
+            while len(in_flight) < workers:
+                if downloads:
+                    url, download_link = downloads.pop()
+                    in_flight[executor.submit(get_interpret_result, download_link, output_directory, url,
+                                              session)] = ("download", url, None, None)
+                elif schedule and schedule[0][0] <= now and not expired:
+                    _, _, url, request_id, delay = heapq.heappop(schedule)
+                    in_flight[executor.submit(get_interpret_status, session, request_id)] = \
+                        ("status", url, request_id, delay)
+                elif unsubmitted and not expired:
+                    url = unsubmitted.pop()
+                    in_flight[executor.submit(submit_interpret_request, session, url, screenshot,
+                                              all_dest_details)] = ("submit", url, None, None)
+                else:
+                    break
+            if expired:
+                for _, _, url, _, _ in schedule:
+                    statuses[url] = STATUS_TIMED_OUT
+                for url in unsubmitted:
+                    statuses[url] = STATUS_TIMED_OUT
+                schedule, unsubmitted = [], []
+            if not in_flight and not schedule and not unsubmitted and not downloads:
+                break
+            if schedule and len(in_flight) < workers:
+                timeout = max(0.0, min(schedule[0][0], deadline) - now)  # a slot is free for the next status check
+            elif schedule or unsubmitted:
+                timeout = max(0.0, deadline - now)  # every slot is busy, so wait for one to free up
+            else:
+                timeout = None
+            if not in_flight:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, url, request_id, delay = in_flight.pop(future)
+                result = future.result()
+                if kind == "submit":
+                    if not result:
+                        statuses[url] = STATUS_FAILED
+                        continue
+                    print(f"Submitted {url} to be interpreted (request {result})")
+                    delay = POLL_INITIAL_DELAY_SECONDS
+                    heapq.heappush(schedule, (time.monotonic() + jitter(delay), sequence, url, result, delay))
+                    sequence += 1
+                elif kind == "status":
+                    status, download_link = result
+                    if status == STATUS_COMPLETE:
+                        downloads += [(url, download_link)]
+                    elif status == STATUS_FAILED:
+                        statuses[url] = STATUS_FAILED
+                    else:
+                        delay = get_next_poll_delay(delay)
+                        heapq.heappush(schedule, (time.monotonic() + jitter(delay), sequence, url, request_id,
+                                                  delay))
+                        sequence += 1
                 else:
-                    try:
-                        data = response.json()
-                        if "status" not in data:
-                            print(f"Failed to interpret URL: {response.text}")
-                            failed = True
-                        else:
-                            if data["status"] == "Failed":
-                                print(f"Something failed while interpreting URL.")
-                                failed = True
-                            elif data["status"] == "Complete":
-                                results = data["download_link"]
-                            # Otherwise we're just waiting on an in progress interpretation.
-                    except Exception as e:
-                        print(f"Error encountered while interpreting URL: {e}")
-                        failed = True
-    return results
+                    statuses[url] = STATUS_COMPLETE if result is not None else STATUS_FAILED
+                    if result is not None:
+                        print(f"Saved {len(result)} interpret result files for {url}")
+    completed = sum(1 for status in statuses.values() if status == STATUS_COMPLETE)
+    print(f"Interpreted {completed} of {len(statuses)} URLs "
+          f"({sum(1 for status in statuses.values() if status == STATUS_TIMED_OUT)} timed out)")
+    return statuses
@@ -0,0 +1,192 @@
+import json
+import re
+
+DEFAULT_CHUNK_SIZE = 65536  # characters read from the underlying file at a time
+WHITESPACE = " \t\n\r"
+DELIMITERS = WHITESPACE + ",:]}"  # characters that can legally follow a complete value
+STRING_SPECIAL_CHARACTERS = re.compile(r'["\\]')
+
+
+class JsonStreamReader:
+    """Incrementally parses a JSON document from a text file without loading the whole thing into memory. Containers
+       are walked with iter_object() and iter_array(), and individual values are decoded with read_value(), so only
+       one value (i.e. one BayseFlow) needs to be held in memory at a time.
+    """
+    def __init__(self, fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.file = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Drops what has already been consumed and reads more of the file. Reads grow with the unconsumed buffer so
+           that a single very large value doesn't get re-scanned once per chunk.
+        """
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.file.read(max(self.chunk_size, len(self.buf)))
+        if not chunk:
+            self.eof = True
+        self.buf += chunk
+
+    def _peek(self):
+        """Returns the next non-whitespace character without consuming it ('' at the end of the file).
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def peek(self):
+        """Returns the first character of the next value without consuming it (e.g. '"' for a string or '{' for an
+           object), or '' at the end of the file.
+        """
+        return self._peek()
+
+    def _next(self):
+        char = self._peek()
+        self.pos += 1
+        return char
+
+    def _expect(self, expected):
+        char = self._next()
+        if char != expected:
+            raise ValueError(f"Expected '{expected}' but found '{char}' while streaming JSON")
+
+    def read_value(self):
+        """Decodes and returns the next complete JSON value.
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if not self.eof and (end == len(self.buf) or self.buf[end] not in DELIMITERS):
+                    raise ValueError("value may continue in the next chunk")  # i.e. a number split across chunks
+            except ValueError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def iter_string(self):
+        """Yields the next JSON string a piece at a time (with escapes decoded), so that a very large string never
+           needs to be held in memory all at once.
+        """
+        self._expect('"')
+        while True:
+            if self.pos >= len(self.buf):
+                if self.eof:
+                    raise ValueError("Unterminated string while streaming JSON")
+                self._fill()
+                continue
+            match = STRING_SPECIAL_CHARACTERS.search(self.buf, self.pos)
+            end = match.start() if match else len(self.buf)
+            if end > self.pos:
+                yield self.buf[self.pos:end]
+                self.pos = end
+            if not match:
+                continue
+            if self.buf[end] == '"':
+                self.pos = end + 1
+                return
+            if end + 12 > len(self.buf) and not self.eof:
+                self._fill()  # make sure the whole escape sequence (at most a surrogate pair) is buffered
+                continue
+            escape_length = 2
+            if self.buf[end + 1:end + 2] == "u":
+                escape_length = 12 if self.buf[end + 2:end + 4].lower() in ("d8", "d9", "da", "db") else 6
+            yield json.loads(f'"{self.buf[end:end + escape_length]}"')
+            self.pos = end + escape_length
+
+    def iter_object(self):
+        """Walks the members of the next JSON object, yielding each key. The caller must consume the member's value
+           (with read_value(), iter_object(), or iter_array()) before asking for the next key.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self._expect(":")
+            yield key
+            char = self._next()
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or '}}' but found '{char}' while streaming JSON")
+
+    def iter_elements(self):
+        """Walks the elements of the next JSON array, yielding each element's index. The caller must consume the
+           element (with read_value(), iter_string(), iter_object(), or iter_array()) before asking for the next one.
+        """
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            char = self._next()
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' but found '{char}' while streaming JSON")
+
+    def iter_array(self):
+        """Yields each decoded element of the next JSON array.
+        """
+        for _ in self.iter_elements():
+            yield self.read_value()
+
+
+class JsonObjectWriter:
+    """Incrementally writes a single JSON object to a text file, using the same formatting as json.dump so the output
+       matches what we'd get from writing the whole object at once. Arrays can be written a batch of items at a time.
+    """
+    def __init__(self, fileobj, dumps=json.dumps):
+        self.file = fileobj
+        self.dumps = dumps
+        self.members = 0
+        self.batches = None  # number of batches written to the array currently open (None if no array is open)
+        self.file.write("{")
+
+    def _write_key(self, key):
+        if self.members:
+            self.file.write(", ")
+        self.file.write(f"{self.dumps(key)}: ")
+        self.members += 1
+
+    def write_member(self, key, value):
+        self._write_key(key)
+        self.file.write(self.dumps(value))
+
+    def begin_array(self, key):
+        self._write_key(key)
+        self.file.write("[")
+        self.batches = 0
+
+    def write_items(self, values):
+        encoded = ", ".join(self.dumps(value) for value in values)
+        if encoded:
+            if self.batches:
+                self.file.write(", ")
+            self.file.write(encoded)
+            self.batches += 1
+
+    def end_array(self):
+        self.file.write("]")
+        self.batches = None
+
+    def close(self):
+        self.file.write("}")
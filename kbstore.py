@@ -0,0 +1,191 @@
+import pathlib
+import platform
+import serializer
+import sqlite3
+import threading
+import time
+
+BAYSE_KB_CACHE_DIRNAME = "bayse_kb"
+KB_STORE_FILENAME = "destinations.sqlite3"
+MAX_STORE_ENTRIES = 500000  # once the store grows past this, the oldest entries are removed
+STORE_TRIM_FRACTION = 0.9  # when a table is trimmed, it's brought down to this fraction of MAX_STORE_ENTRIES
+NO_PORT = -1  # ICMP (and other portless) destinations are stored with this port so the primary key stays unique
+
+
+def get_cache_dir():
+    """Gets (and creates, if it doesn't exist) the cache directory where the Destination KB store lives.
+    """
+    if platform.system().lower() == "windows":
+        destination_kb_cache_dir = pathlib.Path(f"C:\\TEMP\\{BAYSE_KB_CACHE_DIRNAME}")
+    else:
+        destination_kb_cache_dir = pathlib.Path(f"/tmp/{BAYSE_KB_CACHE_DIRNAME}")
+    destination_kb_cache_dir.mkdir(parents=True, exist_ok=True)  # make sure it exists
+    return destination_kb_cache_dir
+
+
+class DestinationStore:
+    """A persistent, single-file (SQLite) store of Destination KB results. Entries are keyed by the full
+       (name, protocol, port) lookup, carry their own expiration time, and survive across runs. Bulk reads and writes
+       each happen in a single transaction so that enriching a large file doesn't pay a commit per destination.
+       Destinations found to have no KB data are remembered in a table of their own (see put_missing), so that they
+       can expire on a different schedule and never get mistaken for real results.
+    """
+    def __init__(self, path=None, max_entries=MAX_STORE_ENTRIES):
+        self.path = str(path) if path else str(get_cache_dir() / KB_STORE_FILENAME)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.size_bounds = dict()  # table -> upper bound on its number of rows, once they've been counted
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS destinations (name TEXT NOT NULL, protocol TEXT NOT NULL, "
+                                "port INTEGER NOT NULL, saved_at REAL NOT NULL, expires_at REAL NOT NULL, "
+                                "data TEXT NOT NULL, PRIMARY KEY (name, protocol, port)) WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS destinations_saved_at ON destinations (saved_at)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS missing (name TEXT NOT NULL, protocol TEXT NOT NULL, "
+                                "port INTEGER NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (name, protocol, port)) "
+                                "WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS missing_expires_at ON missing (expires_at)")
+
+    @staticmethod
+    def _row_key(lookup_key):
+        name, protocol, port = lookup_key
+        return name, protocol, NO_PORT if port is None else port
+
+    def get(self, lookup_key, now=None):
+        """Returns (kb_data, expires_at) for a lookup key, or None if it isn't stored or has expired.
+        """
+        return self.get_many([lookup_key], now).get(lookup_key)
+
+    def get_many(self, lookup_keys, now=None):
+        """Looks up every key in a single transaction. Returns a dictionary mapping each key that has an unexpired
+           entry to its (kb_data, expires_at).
+        """
+        now = now if now else time.time()
+        found = dict()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                for lookup_key in lookup_keys:
+                    row = self.connection.execute("SELECT expires_at, data FROM destinations WHERE name = ? AND "
+                                                  "protocol = ? AND port = ?", self._row_key(lookup_key)).fetchone()
+                    if row and row[0] > now:
+                        try:
+                            found[lookup_key] = (serializer.loads(row[1]), row[0])
+                        except ValueError as e:
+                            print(f"Ignoring unreadable Destination KB store entry for {lookup_key}: {e}")
+            finally:
+                self.connection.execute("COMMIT")
+        return found
+
+    def put(self, lookup_key, kb_data, expiration_seconds):
+        self.put_many({lookup_key: kb_data}, expiration_seconds)
+
+    def put_many(self, kb_results, expiration_seconds):
+        """Saves a dictionary of lookup key -> kb_data in a single transaction, each entry expiring
+           `expiration_seconds` from now. Afterwards, the store is trimmed back down to its size cap if necessary.
+        """
+        if not kb_results:
+            return
+        now = time.time()
+        rows = [(*self._row_key(lookup_key), now, now + expiration_seconds, serializer.dumps(kb_data))
+                for lookup_key, kb_data in kb_results.items()]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO destinations (name, protocol, port, saved_at, "
+                                            "expires_at, data) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.connection.executemany("DELETE FROM missing WHERE name = ? AND protocol = ? AND port = ?",
+                                            [row[:3] for row in rows])
+                self._enforce_size_cap("destinations", "saved_at", len(rows))
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                self.size_bounds.clear()
+                raise
+            self.connection.execute("COMMIT")
+
+    def get_missing(self, lookup_keys, now=None):
+        """Returns the set of lookup keys that were recently found to have no KB data (and haven't expired since), in
+           a single transaction.
+        """
+        now = now if now else time.time()
+        missing = set()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                for lookup_key in lookup_keys:
+                    row = self.connection.execute("SELECT expires_at FROM missing WHERE name = ? AND protocol = ? AND "
+                                                  "port = ?", self._row_key(lookup_key)).fetchone()
+                    if row and row[0] > now:
+                        missing.add(lookup_key)
+            finally:
+                self.connection.execute("COMMIT")
+        return missing
+
+    def put_missing(self, lookup_keys, expiration_seconds):
+        """Remembers, in a single transaction, that each of `lookup_keys` has no KB data for `expiration_seconds`.
+        """
+        expires_at = time.time() + expiration_seconds
+        rows = [(*self._row_key(lookup_key), expires_at) for lookup_key in lookup_keys]
+        if not rows:
+            return
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany("INSERT OR REPLACE INTO missing (name, protocol, port, expires_at) "
+                                            "VALUES (?, ?, ?, ?)", rows)
+                self._enforce_size_cap("missing", "expires_at", len(rows))
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                self.size_bounds.clear()
+                raise
+            self.connection.execute("COMMIT")
+
+    def _enforce_size_cap(self, table, oldest_first, added=0):
+        """Keeps a table within the size cap without counting its rows on every write. An upper bound on its size is
+           kept instead (as if each of the `added` rows just written was new), and the rows are only counted once that
+           bound passes the cap. If there are more than STORE_TRIM_FRACTION of the cap, the oldest (by the
+           `oldest_first` column) are removed, so that the next count is a long way off. Must be called with the lock
+           held, inside a transaction.
+        """
+        bound = self.size_bounds.get(table)
+        if bound is not None and bound + added <= self.max_entries:
+            self.size_bounds[table] = bound + added
+            return
+        count = self.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        target = int(self.max_entries * STORE_TRIM_FRACTION)
+        if count > target:
+            self.connection.execute(f"DELETE FROM {table} WHERE (name, protocol, port) IN (SELECT name, protocol, port "
+                                    f"FROM {table} ORDER BY {oldest_first} LIMIT ?)", (count - target,))
+            count = target
+        self.size_bounds[table] = count
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM destinations").fetchone()[0]
+
+    def compact(self):
+        """Removes expired entries, enforces the size cap, and reclaims the freed space on disk. Returns the number of
+           entries removed.
+        """
+        with self.lock:
+            before = self.connection.execute("SELECT COUNT(*) FROM destinations").fetchone()[0]
+            self.size_bounds.clear()  # so that both tables are counted
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute("DELETE FROM destinations WHERE expires_at <= ?", (time.time(),))
+                self.connection.execute("DELETE FROM missing WHERE expires_at <= ?", (time.time(),))
+                self._enforce_size_cap("destinations", "saved_at")
+                self._enforce_size_cap("missing", "expires_at")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                self.size_bounds.clear()
+                raise
+            self.connection.execute("COMMIT")
+            after = self.connection.execute("SELECT COUNT(*) FROM destinations").fetchone()[0]
+            self.connection.execute("VACUUM")
+        return before - after
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,46 +1,200 @@
+from classifier import DestinationClassifier, QUERY, SKIP
+import collections
 import config
-import datetime
-import ipaddress
-import json
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import httpclient
+import jsonstream
+import kbstore
+import metrics
+import os
 import pathlib
-import pickle
-import platform
 import requests
+import serializer
+import shutil
+import tempfile
+import threading
+import time
 
-BAYSE_KB_CACHE_DIRNAME = "bayse_kb"
 CACHE_EXPIRATION_AS_FLOAT_SECONDS = 86400.00  # one day
+MISSING_EXPIRATION_SECONDS = 3600.0  # how long a destination without KB data is remembered as such (it may gain some)
+INCOMPLETE_EXPIRATION_SECONDS = 900.0  # how soon a file with destinations that couldn't be looked up is due again
+DEFAULT_KB_WORKERS = 16  # number of Destination KB lookups allowed in flight at once
+FLOW_BATCH_SIZE = 5000  # BayseFlows held in memory and enriched together while streaming a file
+BAYSEFLOW_FILE_FIELDS = ["hash", "trafficDate", "fileName"]  # top-level fields kept alongside the BayseFlows
+BAYSEFLOW_OUTPUT_FIELDS = ["src", "dst", "destinationNameSource", "srcPkts", "srcBytes", "dstPkts", "dstBytes",
+                           "relativeStart", "protocolInformation", "identifier", "duration", "label"]
+KNOWLEDGE_FIELDS = ["destination_knowledge", "destination_stats", "destination_flow_summary", "parent_knowledge"]
+DESTINATIONS_TABLE_FIELD = "destinations"  # top-level table of each destination's knowledge in a compact file
+DESTINATION_REF_FIELD = "destination_ref"  # a flow's key into the destinations table in a compact file
+DEFAULT_BATCH_SIZE = 100  # number of destinations sent in each batch query (0 disables batch queries)
+BATCH_UNSUPPORTED_STATUS_CODES = [400, 403, 404, 405, 501]  # the server doesn't know about batch queries
+NO_DATA_STATUS_CODES = [200, 404]  # the server answered the query, so a lack of data is worth remembering
+MEMORY_CACHE_MAX_ENTRIES = 10000  # most Destination KB results kept in memory before evicting the least recently used
 
 
-def get_destination_info(session, dst, protocolinfo, port, use_cache=True, verbose=False):
-    """Either queries the Destination Knowledgebase or loads data from the cache. Returns the resulting data.
+class MemoryCache:
+    """A bounded, thread-safe, in-process cache of Destination KB results that sits in front of the on-disk cache.
+       Entries are keyed by the full (name, protocol, port) lookup, evicted in least-recently-used order once the cache
+       is full, and expire after the same CACHE_EXPIRATION_AS_FLOAT_SECONDS used by the on-disk cache.
+    """
+    def __init__(self, max_entries=MEMORY_CACHE_MAX_ENTRIES, expiration_seconds=CACHE_EXPIRATION_AS_FLOAT_SECONDS):
+        self.max_entries = max_entries
+        self.expiration_seconds = expiration_seconds
+        self.entries = collections.OrderedDict()  # lookup key -> (expiration time, kb_data)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, lookup_key):
+        """Returns the cached data for a lookup key (or None if it isn't cached or has expired).
+        """
+        with self.lock:
+            entry = self.entries.get(lookup_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, kb_data = entry
+            if time.monotonic() >= expires_at:
+                del self.entries[lookup_key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(lookup_key)
+            self.hits += 1
+            return kb_data
+
+    def put(self, lookup_key, kb_data, expiration_seconds=None):
+        """Stores data for a lookup key, evicting the least recently used entries if the cache is full. Callers that
+           load an entry from the persistent store pass its remaining lifetime so it doesn't outlive the stored copy.
+        """
+        if expiration_seconds is None:
+            expiration_seconds = self.expiration_seconds
+        with self.lock:
+            self.entries[lookup_key] = (time.monotonic() + expiration_seconds, kb_data)
+            self.entries.move_to_end(lookup_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns the cache's counters so callers can report on how effective it was.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0
+                    }
+
+
+class SingleFlight:
+    """Tracks the lookup keys whose Destination KB queries are in flight, so that concurrent callers asking for the
+       same destination share one query instead of each sending their own. A caller claims the keys it wants, queries
+       the ones it was given, and then releases them with its results, which wakes up every caller waiting on them.
+    """
+    def __init__(self):
+        self.in_flight = dict()  # lookup key -> Future resolved with the results of the query that covers it
+        self.lock = threading.Lock()
+
+    def claim(self, lookup_keys):
+        """Returns (the lookup keys this caller should query, {lookup key: Future} for keys someone else is already
+           querying).
+        """
+        owned, waiting = [], dict()
+        with self.lock:
+            for lookup_key in lookup_keys:
+                future = self.in_flight.get(lookup_key)
+                if future is None:
+                    self.in_flight[lookup_key] = Future()
+                    owned += [lookup_key]
+                else:
+                    waiting[lookup_key] = future
+        return owned, waiting
+
+    def release(self, lookup_keys, results):
+        """Hands `results` (a dictionary of lookup key -> KB data that leaves out any key whose query failed) to every
+           caller waiting on `lookup_keys`. Must be called for every claimed key, even if the query failed.
+        """
+        with self.lock:
+            futures = [self.in_flight.pop(lookup_key) for lookup_key in lookup_keys]
+        for future in futures:
+            future.set_result(results)
+
+
+MEMORY_CACHE = MemoryCache()  # shared by every lookup in this process
+MISSING_CACHE = MemoryCache(expiration_seconds=MISSING_EXPIRATION_SECONDS)  # lookup key -> True if it has no KB data
+IN_FLIGHT = SingleFlight()  # Destination KB queries being made by any thread in this process
+STORE = None  # persistent Destination KB store, opened on first use by get_store()
+STORE_LOCK = threading.Lock()
+BATCH_SUPPORTED = True  # flips to False (for the rest of the run) once the server tells us it can't handle batches
+
+
+def get_destination_url(dst, protocolinfo, port):
+    """Builds the Destination Knowledgebase query URL for a single destination.
     """
-    data = None
     if port:
         url = f"{config.BAYSE_KB_API_URL}?name={dst}&protocol={protocolinfo}&port={port}&getStatistics=true" \
               f"&getFlowSummary=true"
     else:
         url = f"{config.BAYSE_KB_API_URL}?name={dst}&protocol={protocolinfo}&getStatistics=true&getFlowSummary=true"
+    return url
+
+
+def get_destination_info(session, dst, protocolinfo, port, use_cache=True, verbose=False):
+    """Either queries the Destination Knowledgebase or loads data from the cache. Returns the resulting data.
+    """
+    url = get_destination_url(dst, protocolinfo, port)
     # determine if cached results exist and are still valid
     if use_cache:
         if verbose:
             print("we want to use the cache...do we have data?")
-        # try to retrieve
-        data = retrieve_cached_results(dst, session, url)
+        # check memory first so repeat lookups don't touch the disk at all
+        lookup_key = (dst, protocolinfo, port)
+        data = MEMORY_CACHE.get(lookup_key)
         if data:
             if verbose:
-                print("Got data from cache")
-        else:
-            # if nothing stored, save and return that data
-            print("Nothing stored, so getting a fresh copy to save")
-            response = session.get(url)
-            data = get_kb_data_from_response(response)
-            data = save_results_to_cache(dst, data)
+                print("Got data from memory cache")
+            metrics.increment("kb_cache_hits")
+            return data
+        # try to retrieve (this gets and saves a fresh copy if nothing valid is stored)
+        data = retrieve_cached_results(lookup_key, session)
+        if data and verbose:
+            print("Got data from cache")
     else:
-        response = session.get(url)
-        data = get_kb_data_from_response(response)
+        data = fetch_destination_info(session, url)
     return data
 
 
+def fetch_destination_info(session, url):
+    """Queries the Destination Knowledgebase directly, bypassing every cache. Raises a requests.RequestException if
+       the server didn't answer the query (it kept failing with a transient error, or was refused, e.g. with a 401
+       because the API key is wrong), so that it isn't mistaken for a destination with no KB data.
+    """
+    start = time.perf_counter()
+    try:
+        response = session.get(url)
+        if response.status_code not in NO_DATA_STATUS_CODES:
+            raise requests.HTTPError(f"Destination KB query failed with status {response.status_code}",
+                                     response=response)
+    except requests.RequestException:
+        metrics.increment("kb_http_errors")
+        raise
+    finally:
+        metrics.observe("kb_http_latency", time.perf_counter() - start)
+        metrics.increment("kb_http_requests")
+    return get_kb_data_from_response(response)
+
+
 def get_kb_data_from_response(response):
     """Since we need to work through the response data in a few scenarios, this function handles taking a raw
        response and returning only the JSON data we want (or None if no/invalid data).
@@ -48,203 +202,542 @@ def get_kb_data_from_response(response):
     kb_data = None
     if response.status_code == 200:
         try:
-            if "body" in response.json():
-                return response.json()["body"]
+            data = serializer.loads(response.content)
+            if "body" in data:
+                return data["body"]
         except:
             return kb_data
     return kb_data
 
 
-def get_filename(destination):
-    """Gets (and creates, if it doesn't exist) the cache directory where pickle data is stored and creates the filename.
+def get_store():
+    """Returns the persistent Destination KB store shared by this process, opening it on first use.
+    """
+    global STORE
+    with STORE_LOCK:
+        if STORE is None:
+            STORE = kbstore.DestinationStore()
+        return STORE
+
+
+def retrieve_cached_results(lookup_key, session):
+    """Retrieves Destination Knowledgebase results that are cached and returns them to object format. If nothing valid
+       is cached, a new lookup occurs (shared with any identical lookup already in flight), is saved, and then
+       returned; a destination with no KB data is remembered as such for MISSING_EXPIRATION_SECONDS. Raises a
+       requests.RequestException if the lookup failed, since nothing is known about the destination.
+    """
+    results = resolve_destinations(session, [lookup_key], workers=1, batch_size=0)
+    if lookup_key not in results:
+        raise requests.RequestException(f"Couldn't get Destination KB data for {lookup_key}")
+    return results[lookup_key]
+
+
+def compact_cache():
+    """Removes expired and excess entries from the persistent Destination KB store and reclaims their disk space.
+    """
+    store = get_store()
+    removed = store.compact()
+    print(f"Removed {removed} entries from the Destination KB store at {store.path}; {store.count()} remain.")
+
+
+def resolve_destinations(session, lookup_keys, workers=DEFAULT_KB_WORKERS, use_cache=True,
+                         batch_size=DEFAULT_BATCH_SIZE):
+    """Takes a collection of unique (destination, protocol, port) lookup keys and resolves them. Cached results, and
+       destinations recently found to have no KB data, are read from memory and then from the persistent store in one
+       bulk transaction. The remainder are queried in batches (see get_destination_info_batch), except for any that
+       another thread is already querying, whose results are shared instead (see SingleFlight). What was found is
+       saved back to the store in one bulk transaction, and what wasn't is remembered for MISSING_EXPIRATION_SECONDS.
+       Returns a dictionary mapping each lookup key to its Destination KB data (or None), leaving out any lookup key
+       that couldn't be resolved because of a transient error.
+    """
+    results = dict()
+    pending = set(lookup_keys)
+    if use_cache and pending:
+        for lookup_key in list(pending):
+            data = MEMORY_CACHE.get(lookup_key)
+            if data:
+                results[lookup_key] = data
+                pending.discard(lookup_key)
+            elif MISSING_CACHE.get(lookup_key):
+                results[lookup_key] = None
+                pending.discard(lookup_key)
+        metrics.increment("kb_memory_cache_hits", len(results))
+        try:
+            with metrics.stage("kb_store_read"):
+                store = get_store()
+                cached = store.get_many(pending)
+                missing = store.get_missing(pending.difference(cached))
+        except Exception as e:
+            print(f"Failed to read Destination KB Data from cache: {e}")
+            cached, missing = dict(), set()
+        now = time.time()
+        for lookup_key, (data, expires_at) in cached.items():
+            results[lookup_key] = data
+            MEMORY_CACHE.put(lookup_key, data, expires_at - now)
+            pending.discard(lookup_key)
+        for lookup_key in missing:
+            results[lookup_key] = None
+            MISSING_CACHE.put(lookup_key, True)
+            pending.discard(lookup_key)
+        metrics.increment("kb_store_hits", len(cached) + len(missing))
+        metrics.increment("kb_cache_hits", len(results))
+        metrics.increment("kb_missing_cache_hits", sum(1 for data in results.values() if data is None))
+        metrics.increment("kb_cache_misses", len(pending))
+    if not pending:
+        return results
+    owned, waiting = IN_FLIGHT.claim(pending)
+    fetched = dict()
+    try:
+        if owned:
+            with metrics.stage("kb_network_lookup"):
+                fetched = get_destination_info_batch(session, owned, batch_size, workers)
+            if use_cache:
+                save_results_to_cache(fetched)
+    finally:
+        IN_FLIGHT.release(owned, fetched)
+    results.update(fetched)
+    if waiting:
+        metrics.increment("kb_coalesced_lookups", len(waiting))
+        with metrics.stage("kb_coalesced_wait"):
+            for lookup_key, future in waiting.items():
+                shared = future.result()
+                if lookup_key in shared:
+                    results[lookup_key] = shared[lookup_key]
+    return results
+
+
+def save_results_to_cache(kb_results):
+    """Saves freshly queried Destination KB results to the persistent store and memory in bulk. Destinations with data
+       are cached for CACHE_EXPIRATION_AS_FLOAT_SECONDS, and destinations without any are remembered separately (and
+       for only MISSING_EXPIRATION_SECONDS) so that they aren't queried again for every flow that goes to them.
+    """
+    found = {lookup_key: data for lookup_key, data in kb_results.items() if data}
+    missing = [lookup_key for lookup_key, data in kb_results.items() if not data]
+    try:
+        with metrics.stage("kb_store_write"):
+            store = get_store()
+            store.put_many(found, CACHE_EXPIRATION_AS_FLOAT_SECONDS)
+            store.put_missing(missing, MISSING_EXPIRATION_SECONDS)
+    except Exception as e:
+        print(f"Failed to save Destination KB Data to cache: {e}")
+    for lookup_key, data in found.items():
+        MEMORY_CACHE.put(lookup_key, data)
+    for lookup_key in missing:
+        MISSING_CACHE.put(lookup_key, True)
+
+
+def get_destination_info_batch(session, lookup_keys, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_KB_WORKERS):
+    """Queries the Destination Knowledgebase for many (destination, protocol, port) lookup keys at once, bypassing
+       every cache. Keys are split into chunks of `batch_size` that are sent concurrently. Any key the server leaves
+       out of (or reports an error for in) a batch response, or whose whole batch keeps failing, is queried on its own
+       instead. If the server doesn't support batch queries (or `batch_size` is 0), every key is queried on its own.
+       Returns a dictionary mapping each lookup key to its Destination KB data (or None), leaving out any lookup key
+       whose individual query failed.
     """
-    if platform.system().lower() == "windows":
-        destination_kb_cache_dir = str(pathlib.PurePath(f"C:\\TEMP\\{BAYSE_KB_CACHE_DIRNAME}"))
-        delimiter = "\\"
+    lookup_keys = list(lookup_keys)
+    results = dict()
+    if batch_size and BATCH_SUPPORTED:
+        query_individually = []
+        chunks = [lookup_keys[i:i + batch_size] for i in range(0, len(lookup_keys), batch_size)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk, chunk_results in zip(chunks, executor.map(lambda c: fetch_destination_batch(session, c),
+                                                                 chunks)):
+                if chunk_results is None:
+                    query_individually += chunk
+                else:
+                    results.update(chunk_results)
+                    query_individually += [lookup_key for lookup_key in chunk if lookup_key not in chunk_results]
     else:
-        destination_kb_cache_dir = str(pathlib.PurePath(f"/tmp/{BAYSE_KB_CACHE_DIRNAME}"))
-        delimiter = "/"
-    pathlib.Path(destination_kb_cache_dir).mkdir(parents=True, exist_ok=True)  # make sure it exists
-    filename = f"{destination_kb_cache_dir}{delimiter}{destination}.pkl"
-    return filename
+        query_individually = lookup_keys
+    if query_individually:
+        results.update(fetch_destinations_individually(session, query_individually, workers))
+    return results
 
 
-def save_results_to_cache(destination, kb_data):
-    """This occurs when we don't have cached Destination KB results and want to save some. Generally, we should cache
-       when we don't AND when the results look fully-formed.
+def fetch_destination_batch(session, chunk):
+    """Sends a single batch query for a chunk of lookup keys (the session retries it if it fails with a transient
+       error). Returns a dictionary of the lookup keys the server answered, or None if the batch couldn't be completed.
     """
-    now_utc = float(datetime.datetime.utcnow().strftime('%s'))
-    filename = get_filename(destination)
+    global BATCH_SUPPORTED
+    if not BATCH_SUPPORTED:
+        return None
+    payload = {"destinations": [{"name": dst, "protocol": protocolinfo, "port": port}
+                                for dst, protocolinfo, port in chunk],
+               "getStatistics": True,
+               "getFlowSummary": True
+               }
+    start = time.perf_counter()
+    try:
+        # a batch query only reads, so it's safe to send again if it fails partway through
+        response = session.post(config.BAYSE_KB_BATCH_API_URL, json=payload, idempotent=True)
+    except requests.RequestException as e:
+        print(f"Destination KB batch query failed: {e}")
+        metrics.increment("kb_http_errors")
+        return None
+    finally:
+        metrics.observe("kb_batch_http_latency", time.perf_counter() - start)
+        metrics.increment("kb_batch_http_requests")
+    if response.status_code in BATCH_UNSUPPORTED_STATUS_CODES:
+        if BATCH_SUPPORTED:
+            BATCH_SUPPORTED = False
+            print("Destination KB batch queries aren't supported. Falling back to individual queries.")
+        return None
+    if response.status_code != 200:
+        print(f"Destination KB batch query failed with status {response.status_code}")
+        return None
     try:
-        cache_file = open(filename, "wb")
-        # add a last_saved field that identifies the current time
-        kb_data["last_saved"] = now_utc
-        pickle.dump(kb_data, cache_file)
-        #print("Successfully saved Destination KB Data to cache.")
-        cache_file.close()
+        entries = serializer.loads(response.content)["body"]["results"]
     except Exception as e:
-        print(f"Failed to save Destination KB Data to temporary cache: {e}")
+        print(f"Got an unexpected Destination KB batch response: {e}")
+        return None
+    wanted = set(chunk)
+    chunk_results = dict()
+    for entry in entries:
         try:
-            cache_file.close()
-        except:
-            pass
+            lookup_key = (entry["name"], entry["protocol"], entry.get("port"))
+        except (KeyError, TypeError):
+            continue
+        if lookup_key in wanted and "error" not in entry:
+            chunk_results[lookup_key] = entry.get("body")
+    return chunk_results
 
 
-def retrieve_cached_results(destination, session, url):
-    """Retrieves Destination Knowledgebase results that are cached and returns them to object format. If the results
-       indicate that the last observed time is more than two weeks ago, a new lookup should occur, be saved (if it's
-       fully-formed), and then returned in place of the existing cache result.
+def fetch_destinations_individually(session, lookup_keys, workers=DEFAULT_KB_WORKERS):
+    """Queries the Destination Knowledgebase for each lookup key on its own, with up to `workers` queries in flight.
+       Returns a dictionary mapping each lookup key to its Destination KB data (or None). Lookup keys whose query
+       failed are left out, so that callers don't mistake them for destinations with no KB data.
+    """
+    results = dict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_destination_info, session, get_destination_url(dst, protocolinfo, port)):
+                   (dst, protocolinfo, port) for dst, protocolinfo, port in lookup_keys}
+        for future in as_completed(futures):
+            lookup_key = futures[future]
+            try:
+                results[lookup_key] = future.result()
+            except Exception as e:
+                print(f"Failed to get Destination KB data for {lookup_key}: {e}")
+    return results
+
+
+def add_kb_data_to_flow(flow, kb_data):
+    """Infuses a single BayseFlow with the destination_knowledge, destination_stats, destination_flow_summary, and
+       parent_knowledge found in the Destination KB data for its destination.
     """
-    get_fresh = False
-    kb_data = None
-    filename = get_filename(destination)
     try:
-        cache_file = open(filename, "rb")
-        kb_data = pickle.load(cache_file)
-    except pickle.UnpicklingError as e:
-        print(f"Error unpickling: {e}")
-        get_fresh = True
-        cache_file.close()
+        save_data = kb_data["destination_info"]["knowledge"]
+        try:
+            nameport = list(save_data.keys())[0]
+            info = save_data[nameport]
+        except:
+            nameport = None
+            info = {}
+        flow["destination_knowledge"] = {"destination_nameport": nameport, "info": info}
     except:
-        get_fresh = True
+        flow["destination_knowledge"] = None
+    try:
+        save_data = kb_data["destination_info"]["statistics"]
+        flow["destination_stats"] = save_data
+    except:
+        flow["destination_stats"] = None
+    try:
+        save_data = kb_data["destination_info"]["flow_summary"]
         try:
-            cache_file.close()
+            nameport = list(save_data.keys())[0]
+            info = save_data[nameport]
         except:
-            pass
-    """Check to see if the cached Destination KB result was last saved more than 1 day ago. If so, request a fresh 
-       Desination KB lookup and store it (if it looks okay).
-    """
-    now_utc = float(datetime.datetime.utcnow().strftime('%s'))
+            nameport = None
+            info = {}
+        flow["destination_flow_summary"] = {"destination_nameport": nameport, "info": info}
+    except:
+        flow["destination_flow_summary"] = None
     try:
-        if kb_data and "last_saved" in kb_data:
-            last_saved_time = kb_data["last_saved"]
-            if now_utc - CACHE_EXPIRATION_AS_FLOAT_SECONDS >= last_saved_time:  # should request a fresh copy
-                get_fresh = True
-        else:
-            get_fresh = True
+        save_data = kb_data["parent_info"]["knowledge"]
+        try:
+            nameport = list(save_data.keys())[0]
+            info = save_data[nameport]
+        except:
+            nameport = None
+            info = {}
+        flow["parent_knowledge"] = {"parent_nameport": nameport, "info": info}
     except:
-        get_fresh = True
-    if get_fresh:
-        response = session.get(url)
-        kb_data = get_kb_data_from_response(response)
-        if kb_data:
-            save_results_to_cache(destination, kb_data)
+        flow["parent_knowledge"] = None
+
+
+def get_infused_bayseflow(flow):
+    """Returns the subset of BayseFlow fields (plus Bayse knowledge) that we store in the infused output file.
+    """
+    return {field: flow[field] for field in BAYSEFLOW_OUTPUT_FIELDS + KNOWLEDGE_FIELDS}
+
+
+def get_compact_bayseflow(flow):
+    """Returns the subset of BayseFlow fields that we store in a compact output file, where the flow's Bayse knowledge
+       is replaced by a reference to its destination in the file's destinations table.
+    """
+    compact = {field: flow[field] for field in BAYSEFLOW_OUTPUT_FIELDS}
+    compact[DESTINATION_REF_FIELD] = flow[DESTINATION_REF_FIELD]
+    return compact
+
+
+def get_destination_ref(lookup_key):
+    """Returns the key used for a destination in a compact file's destinations table (e.g. `example.com_TCP/443`).
+    """
+    dst, protocolinfo, port = lookup_key
+    return f"{dst}_{protocolinfo}/{port}" if port is not None else f"{dst}_{protocolinfo}"
+
+
+def enrich_flows(session, flows, classifier, workers=DEFAULT_KB_WORKERS, use_cache=True,
+                 batch_size=DEFAULT_BATCH_SIZE, destinations=None):
+    """Infuses a batch of BayseFlows (in place) with Bayse knowledge. `classifier` (a DestinationClassifier) decides
+       which destinations are private or internal and skipped; the remaining unique destinations in the batch are
+       resolved together.
+
+       If a `destinations` table (a dictionary) is given, each flow gets a reference to its destination instead of
+       its own copy of the knowledge, and the knowledge is added to the table once per destination. Destinations
+       already in the table (i.e. from earlier batches of the same file) aren't resolved again.
+
+       Returns the set of lookup keys that couldn't be resolved because of a transient error (their flows get no
+       knowledge, the same as destinations without KB data).
+    """
+    decisions = [classifier.classify(flow) for flow in flows]
+    unique_keys = {lookup_key for decision, lookup_key in decisions if decision == QUERY}
+    if destinations is not None:
+        unique_keys = {lookup_key for lookup_key in unique_keys if get_destination_ref(lookup_key) not in destinations}
+    for lookup_key in unique_keys:
+        metrics.track_unique("destinations", lookup_key)
+    metrics.increment("flows_enriched", len(flows))
+    metrics.increment("flows_skipped", sum(1 for decision, _ in decisions if decision == SKIP))
+    kb_results = resolve_destinations(session, unique_keys, workers, use_cache, batch_size)
+    for flow, (decision, lookup_key) in zip(flows, decisions):
+        if destinations is not None:
+            if decision == SKIP:
+                flow[DESTINATION_REF_FIELD] = None
+                continue
+            destination_ref = get_destination_ref(lookup_key)
+            if destination_ref not in destinations:
+                destinations[destination_ref] = dict()
+                add_kb_data_to_flow(destinations[destination_ref], kb_results.get(lookup_key))
+            flow[DESTINATION_REF_FIELD] = destination_ref
+        elif decision != SKIP:
+            add_kb_data_to_flow(flow, kb_results.get(lookup_key))
         else:
-            print("New results don't look right. Not saving.")
-    # remove the cache file's last_saved field, if it exists
+            flow["destination_knowledge"] = {}
+            flow["destination_stats"] = {}
+            flow["destination_flow_summary"] = {}
+            flow["parent_knowledge"] = {}
+    return unique_keys.difference(kb_results)
+
+
+def expand_bayseflow(flow, destinations):
+    """Takes a BayseFlow from a compact file and returns it in the regular infused layout, with its own copy of its
+       destination's knowledge from the `destinations` table.
+    """
+    knowledge = destinations.get(flow[DESTINATION_REF_FIELD]) if flow[DESTINATION_REF_FIELD] else None
+    flow = dict(flow)
+    flow.update(knowledge if knowledge else {field: {} for field in KNOWLEDGE_FIELDS})
+    return get_infused_bayseflow(flow)
+
+
+def get_flow_batches(flows, flow_batch_size):
+    """Groups a stream of BayseFlows into lists of at most `flow_batch_size` flows.
+    """
+    batch = []
+    for flow in flows:
+        batch += [flow]
+        if len(batch) >= flow_batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@contextlib.contextmanager
+def replace_file(fname):
+    """Yields a temporary text file in the same directory as `fname` that atomically replaces it if the `with` block
+       finishes without raising (and is discarded otherwise). The file is compressed the same way as `fname`.
+    """
+    compression_suffix = serializer.COMPRESSION_SUFFIXES.get(serializer.get_compression(fname), "")
+    tmp_fd, tmp_filename = tempfile.mkstemp(prefix=f".{fname.name}.", suffix=f".tmp{compression_suffix}",
+                                            dir=fname.parent)
+    os.close(tmp_fd)
     try:
-        del kb_data["last_saved"]
-    except:
-        pass
-    return kb_data
+        with serializer.open_text(tmp_filename, 'w') as outfile:
+            yield outfile
+        shutil.copymode(fname, tmp_filename)  # mkstemp creates the file as owner-only
+        os.replace(tmp_filename, fname)
+    finally:
+        pathlib.Path(tmp_filename).unlink(missing_ok=True)
 
 
-def add_knowledge_for_files_in_dir(directory):
+def add_knowledge_for_file(fname, session, classifier, workers=DEFAULT_KB_WORKERS, use_cache=True,
+                           batch_size=DEFAULT_BATCH_SIZE, flow_batch_size=FLOW_BATCH_SIZE, compact=False):
+    """Streams a single BayseFlow file through enrichment. The BayseFlows array is parsed incrementally and enriched
+       `flow_batch_size` flows at a time, and the output is written incrementally to a temporary file in the same
+       directory that atomically replaces the original once it is complete. Memory use therefore depends on the
+       batch size rather than on the size of the file. Returns a (top-level fields (i.e. its hash), number of
+       destinations that couldn't be looked up) tuple if the file was enriched, or None if it wasn't.
+
+       If `compact` is True, the file is written in the compact layout: each destination's knowledge is stored once in
+       a top-level destinations table (written after the BayseFlows) and each flow refers to it by key (see
+       expand_bayseflow_file to turn it back into the regular layout).
+    """
+    fname = pathlib.Path(fname)
+    destinations = dict() if compact else None
+    get_output_bayseflow = get_compact_bayseflow if compact else get_infused_bayseflow
+    try:
+        with serializer.open_text(fname) as infile, replace_file(fname) as outfile:
+            reader = jsonstream.JsonStreamReader(infile)
+            writer = jsonstream.JsonObjectWriter(outfile, dumps=serializer.dumps)
+            fields = dict()
+            unresolved = set()
+            for key in reader.iter_object():
+                if key == "BayseFlows":
+                    writer.begin_array(key)
+                    batches = get_flow_batches(reader.iter_array(), flow_batch_size)
+                    while True:
+                        with metrics.stage("json_parse"):
+                            flows = next(batches, None)
+                        if flows is None:
+                            break
+                        with metrics.stage("kb_enrich"):
+                            unresolved |= enrich_flows(session, flows, classifier, workers, use_cache, batch_size,
+                                                       destinations)
+                        with metrics.stage("json_serialize"):
+                            writer.write_items(get_output_bayseflow(flow) for flow in flows)
+                    writer.end_array()
+                else:
+                    with metrics.stage("json_parse"):
+                        value = reader.read_value()
+                    if key in BAYSEFLOW_FILE_FIELDS:
+                        writer.write_member(key, value)
+                        fields[key] = value
+            if compact:
+                with metrics.stage("json_serialize"):
+                    writer.write_member(DESTINATIONS_TABLE_FIELD, destinations)
+            writer.close()
+            metrics.increment("bytes_read", os.path.getsize(fname))
+        metrics.increment("bytes_written", os.path.getsize(fname))
+        metrics.increment("files_enriched")
+        return fields, len(unresolved)
+    except Exception as e:
+        print(f"Failed to add Bayse Knowledge to {fname}: {e}")
+        return None
+
+
+def load_destinations_table(fname):
+    """Returns the destinations table of a compact BayseFlow file, or None if the file isn't compact. The BayseFlows
+       are skipped over one at a time rather than loaded, since the table comes after them.
+    """
+    with serializer.open_text(fname) as infile:
+        reader = jsonstream.JsonStreamReader(infile)
+        destinations = None
+        for key in reader.iter_object():
+            if key == DESTINATIONS_TABLE_FIELD:
+                destinations = reader.read_value()
+            elif key == "BayseFlows":
+                for _ in reader.iter_array():
+                    pass
+            else:
+                reader.read_value()
+    return destinations
+
+
+def iter_expanded_bayseflows(fname):
+    """Yields each BayseFlow in a BayseFlow file in the regular infused layout, expanding them one at a time if the
+       file is compact.
+    """
+    destinations = load_destinations_table(fname)
+    with serializer.open_text(fname) as infile:
+        reader = jsonstream.JsonStreamReader(infile)
+        for key in reader.iter_object():
+            if key != "BayseFlows":
+                reader.read_value()
+                continue
+            for flow in reader.iter_array():
+                yield expand_bayseflow(flow, destinations) if destinations is not None else flow
+
+
+def expand_bayseflow_file(fname, flow_batch_size=FLOW_BATCH_SIZE):
+    """Rewrites a compact BayseFlow file in the regular infused layout, where every flow has its own copy of its
+       destination's knowledge. Returns True if the file was expanded, or False if it wasn't compact.
+    """
+    fname = pathlib.Path(fname)
+    destinations = load_destinations_table(fname)
+    if destinations is None:
+        return False
+    with serializer.open_text(fname) as infile, replace_file(fname) as outfile:
+        reader = jsonstream.JsonStreamReader(infile)
+        writer = jsonstream.JsonObjectWriter(outfile, dumps=serializer.dumps)
+        for key in reader.iter_object():
+            if key == "BayseFlows":
+                writer.begin_array(key)
+                for flows in get_flow_batches(reader.iter_array(), flow_batch_size):
+                    writer.write_items(expand_bayseflow(flow, destinations) for flow in flows)
+                writer.end_array()
+            elif key == DESTINATIONS_TABLE_FIELD:
+                reader.read_value()
+            else:
+                writer.write_member(key, reader.read_value())
+        writer.close()
+    return True
+
+
+def add_knowledge_for_files_in_dir(directory, workers=DEFAULT_KB_WORKERS, pool_size=None,
+                                   batch_size=DEFAULT_BATCH_SIZE, flow_batch_size=FLOW_BATCH_SIZE, compact=False):
     """Takes a directory containing BayseFlow files. For each file, infuses it with destination_knowledge and
     parent_knowledge, destination_stats, and destination_flow_summary information from Bayse.
+
+    Each file is streamed through enrichment `flow_batch_size` flows at a time (see add_knowledge_for_file). The unique
+    destinations in each batch are resolved concurrently with up to `workers` requests in flight (sharing a connection
+    pool of `pool_size`, which defaults to `workers`), `batch_size` destinations per request. Destinations seen in
+    earlier batches or files come straight from the cache. If `compact` is True, files are written in the compact
+    layout (see add_knowledge_for_file).
     """
     print(f"Adding Bayse Knowledge for files in {directory}")
-    s = requests.Session()
-    use_cache = True  # uses the cache temporarily within the same run to avoid hitting the database unnecessarily
-    cached_dests = set()
+    s = httpclient.get_session(pool_size if pool_size else workers)
+    use_cache = True  # reuses Destination KB results saved by this and earlier runs until they expire
+    classifier = DestinationClassifier()  # built once per run
     for fname in pathlib.Path(directory).iterdir():
-        infused_filename = f"{directory}/{fname.name}"
-        infused_data = dict()
-        if fname.is_file() and fname.name.endswith(".bf"):
-            data = None
-            with open(fname, 'r', encoding='utf-8') as f:
-                data = json.loads(f.read())
-            if data:
-                start_ts = float(data["trafficDate"])
-                infused_data = {"hash": data["hash"],
-                                "trafficDate": data["trafficDate"],
-                                "fileName": data["fileName"],
-                                "BayseFlows": []
-                                }
-            for flow in data["BayseFlows"]:
-                query_bayse_knowledge = True
-                if flow["protocolInformation"] == "ICMP":
-                    dst = flow["dst"]
-                    port = None
-                else:
-                    dst_data = flow["dst"].split(":")
-                    port = int(dst_data[-1])
-                    dst = ":".join(dst_data[0:-1])  # handles ipv6 safely
-                if flow["destinationNameSource"] == "original":
-                    try:
-                        if ipaddress.ip_address(dst).is_private:
-                            flow["destination_knowledge"] = {}
-                            flow["destination_stats"] = {}
-                            flow["destination_flow_summary"] = {}
-                            flow["parent_knowledge"] = {}
-                            query_bayse_knowledge = False
-                    except Exception as e:
-                        print(f"Got an unexpected exception with {dst}: {e}")
-                if query_bayse_knowledge:
-                    kb_data = get_destination_info(s, dst, flow["protocolInformation"], port, use_cache)
-                    if use_cache:
-                        cached_dests.add(dst)  # track all of the destinations we need to delete caches for afterwards
-                    try:
-                        save_data = kb_data["destination_info"]["knowledge"]
-                        try:
-                            nameport = list(save_data.keys())[0]
-                            info = save_data[nameport]
-                        except:
-                            nameport = None
-                            info = {}
-                        flow["destination_knowledge"] = {"destination_nameport": nameport, "info": info}
-                    except:
-                        flow["destination_knowledge"] = None
-                    try:
-                        save_data = kb_data["destination_info"]["statistics"]
-                        flow["destination_stats"] = save_data
-                    except:
-                        flow["destination_stats"] = None
-                    try:
-                        save_data = kb_data["destination_info"]["flow_summary"]
-                        try:
-                            nameport = list(save_data.keys())[0]
-                            info = save_data[nameport]
-                        except:
-                            nameport = None
-                            info = {}
-                        flow["destination_flow_summary"] = {"destination_nameport": nameport, "info": info}
-                    except:
-                        flow["destination_flow_summary"] = None
-                    try:
-                        save_data = kb_data["parent_info"]["knowledge"]
-                        try:
-                            nameport = list(save_data.keys())[0]
-                            info = save_data[nameport]
-                        except:
-                            nameport = None
-                            info = {}
-                        flow["parent_knowledge"] = {"parent_nameport": nameport, "info": info}
-                    except:
-                        flow["parent_knowledge"] = None
-                    infused_bayseflow = {
-                        "src": flow["src"],
-                        "dst": flow["dst"],
-                        "destinationNameSource": flow["destinationNameSource"],
-                        "srcPkts": flow["srcPkts"],
-                        "srcBytes": flow["srcBytes"],
-                        "dstPkts": flow["dstPkts"],
-                        "dstBytes": flow["dstBytes"],
-                        "relativeStart": flow["relativeStart"],
-                        "protocolInformation": flow["protocolInformation"],
-                        "identifier": flow["identifier"],
-                        "duration": flow["duration"],
-                        "label": flow["label"],
-                        "destination_knowledge": flow["destination_knowledge"],
-                        "destination_stats": flow["destination_stats"],
-                        "destination_flow_summary": flow["destination_flow_summary"],
-                        "parent_knowledge": flow["parent_knowledge"]
-                    }
-                    infused_data["BayseFlows"] += [infused_bayseflow]
-        with open(infused_filename, "w") as infused_outfile:
-            json.dump(infused_data, infused_outfile)
-    if cached_dests:
-        #print(f"Cleaning up {len(cached_dests)} cache entries to avoid state issues.")
-        for d in cached_dests:
-            fname = get_filename(d)
-            pathlib.Path(fname).unlink(missing_ok=True)
\ No newline at end of file
+        if fname.is_file() and serializer.is_bayseflow_file(fname.name):
+            add_knowledge_for_file(fname, s, classifier, workers, use_cache, batch_size, flow_batch_size, compact)
+    if use_cache:
+        cache_stats = MEMORY_CACHE.stats()
+        print(f"Destination KB memory cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+              f"{cache_stats['evictions']} evictions")
+
+
+def add_knowledge_for_queued_files(bayseflow_queue, workers=DEFAULT_KB_WORKERS, pool_size=None,
+                                   batch_size=DEFAULT_BATCH_SIZE, flow_batch_size=FLOW_BATCH_SIZE, on_enriched=None,
+                                   compact=False):
+    """Acts as the enrichment stage of a pipeline: takes BayseFlow file paths off of `bayseflow_queue` as they are
+       produced and infuses each one with Bayse knowledge (see add_knowledge_for_file) until it receives None. If
+       `on_enriched` is given, it is called with the path and top-level fields of each file that was enriched, and the
+       number of seconds until its knowledge should be refreshed: CACHE_EXPIRATION_AS_FLOAT_SECONDS, or only
+       INCOMPLETE_EXPIRATION_SECONDS if some of its destinations couldn't be looked up. If `compact` is True, files are
+       written in the compact layout. Returns the number of files that were enriched.
+    """
+    s = httpclient.get_session(pool_size if pool_size else workers)
+    use_cache = True  # reuses Destination KB results saved by this and earlier runs until they expire
+    classifier = DestinationClassifier()  # built once per run
+    enriched = 0
+    while True:
+        fname = bayseflow_queue.get()
+        if fname is None:
+            break
+        print(f"Adding Bayse Knowledge to {fname}")
+        result = add_knowledge_for_file(fname, s, classifier, workers, use_cache, batch_size, flow_batch_size,
+                                        compact)
+        if result is not None:
+            fields, unresolved = result
+            enriched += 1
+            expiration_seconds = CACHE_EXPIRATION_AS_FLOAT_SECONDS
+            if unresolved:
+                print(f"Couldn't look up {unresolved} destinations in {fname}. It will be enriched again later.")
+                expiration_seconds = INCOMPLETE_EXPIRATION_SECONDS
+            if on_enriched:
+                on_enriched(fname, fields, expiration_seconds)
+    if use_cache:
+        cache_stats = MEMORY_CACHE.stats()
+        print(f"Destination KB memory cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+              f"{cache_stats['evictions']} evictions")
+    return enriched
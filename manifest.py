@@ -0,0 +1,169 @@
+import hashlib
+import os
+import serializer
+import tempfile
+import threading
+import time
+
+MANIFEST_FILENAME = ".bayse_manifest.json"
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1048576  # bytes read at a time while hashing inputs
+CHECKPOINT_INTERVAL_SECONDS = 30.0  # how often the manifest is saved while a run is in progress
+
+
+def hash_file(path):
+    """Returns the SHA-256 of a file's contents, reading it a chunk at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_file_signature(path, known=None):
+    """Returns the size, mtime, and content hash of a file. If `known` (an earlier signature) has the same size and
+       mtime, its hash is reused instead of reading the whole file again.
+    """
+    stat = os.stat(path)
+    signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if known and known.get("size") == stat.st_size and known.get("mtime_ns") == stat.st_mtime_ns:
+        signature["sha256"] = known["sha256"]
+    else:
+        signature["sha256"] = hash_file(path)
+    return signature
+
+
+class Manifest:
+    """Records what earlier runs did in an output directory so that later runs can skip work that is already done.
+       For each input (a conn.log with its dns.log, or a PCAP) it keeps the size, mtime, and content hash of every file
+       that went into the conversion plus the BayseFlow files it produced. For each BayseFlow file it keeps the file's
+       `hash` field and when its Bayse knowledge expires. Input paths are absolute; output paths are relative to the
+       output directory.
+    """
+    def __init__(self, output_directory):
+        self.output_directory = os.path.abspath(output_directory)
+        self.path = os.path.join(self.output_directory, MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        self.inputs = dict()
+        self.outputs = dict()
+        self.pending = dict()  # input -> signatures of its files, taken just before it was converted
+        self.last_saved = time.monotonic()
+        self.changed = False  # whether anything has been recorded since the manifest was last saved
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = serializer.loads(f.read())
+            if data.get("version") == MANIFEST_VERSION:
+                self.inputs = data.get("inputs", dict())
+                self.outputs = data.get("outputs", dict())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def save(self):
+        """Atomically writes the manifest to the output directory.
+        """
+        with self.lock:
+            data = {"version": MANIFEST_VERSION, "inputs": self.inputs, "outputs": self.outputs}
+            os.makedirs(self.output_directory, exist_ok=True)
+            tmp_fd, tmp_filename = tempfile.mkstemp(prefix=f"{MANIFEST_FILENAME}.", suffix=".tmp",
+                                                    dir=self.output_directory)
+            try:
+                with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
+                    f.write(serializer.dumps(data))
+                os.replace(tmp_filename, self.path)
+            except Exception:
+                os.unlink(tmp_filename)
+                raise
+            self.last_saved = time.monotonic()
+            self.changed = False
+
+    def checkpoint(self):
+        """Saves the manifest if something has changed and it hasn't been saved for a while, so an interrupted run keeps
+           most of its progress.
+        """
+        if self.changed and time.monotonic() - self.last_saved >= CHECKPOINT_INTERVAL_SECONDS:
+            self.save()
+
+    def _relative(self, output_path):
+        return os.path.relpath(os.path.abspath(output_path), self.output_directory)
+
+    def get_unchanged_outputs(self, location, files, force=False):
+        """Checks whether an input needs converting. Returns the absolute paths of the BayseFlow files produced from it
+           last time if none of its `files` have changed (by content hash) and those outputs still exist, or None if it
+           needs to be converted again (or `force` is set). In the latter case, the current signatures are remembered
+           for record_conversion().
+        """
+        location = os.path.abspath(location)
+        with self.lock:
+            entry = self.inputs.get(location)
+        known = entry["files"] if entry else dict()
+        try:
+            signatures = {os.path.abspath(f): get_file_signature(f, known.get(os.path.abspath(f))) for f in files if f}
+        except OSError as e:
+            print(f"Failed to check {location} for changes: {e}")
+            return None
+        outputs = [os.path.join(self.output_directory, output) for output in entry["outputs"]] if entry else []
+        unchanged = entry and {f: s["sha256"] for f, s in signatures.items()} == \
+            {f: s["sha256"] for f, s in known.items()}
+        if unchanged and not force and outputs and all(os.path.isfile(output) for output in outputs):
+            with self.lock:
+                entry["files"] = signatures  # a touched-but-identical file shouldn't need to be hashed again
+                self.changed = True
+            return outputs
+        with self.lock:
+            self.pending[location] = signatures
+        return None
+
+    def record_conversion(self, location, bayseflow_files):
+        """Remembers that an input was successfully converted into `bayseflow_files`.
+        """
+        location = os.path.abspath(location)
+        with self.lock:
+            signatures = self.pending.pop(location, None)
+            if signatures is None:
+                return
+            outputs = [self._relative(f) for f in bayseflow_files]
+            self.inputs[location] = {"files": signatures, "outputs": outputs}
+            for output in outputs:
+                self.outputs.pop(output, None)  # freshly converted, so it hasn't been enriched yet
+            self.changed = True
+        self.checkpoint()
+
+    def needs_enrichment(self, output_path):
+        """Returns True if a BayseFlow file has never been enriched, or if its Bayse knowledge has expired.
+        """
+        with self.lock:
+            entry = self.outputs.get(self._relative(output_path))
+        return not entry or entry.get("expires_at", 0) <= time.time()
+
+    def claim_expired_outputs(self, retry_seconds):
+        """Returns the absolute paths of the BayseFlow files (that still exist) whose Bayse knowledge has expired since
+           they were last enriched, and puts off their expiry by `retry_seconds` so that they aren't returned again
+           while they're being enriched (or, if enriching them fails, until it's worth trying again).
+        """
+        now = time.time()
+        expired = []
+        with self.lock:
+            for output, entry in self.outputs.items():
+                path = os.path.join(self.output_directory, output)
+                if entry.get("expires_at", 0) <= now and os.path.isfile(path):
+                    entry["expires_at"] = now + retry_seconds
+                    expired += [path]
+            if expired:
+                self.changed = True
+        return expired
+
+    def record_enrichment(self, output_path, bayseflow_hash, expiration_seconds):
+        """Remembers that a BayseFlow file was enriched and when that knowledge expires.
+        """
+        now = time.time()
+        with self.lock:
+            self.outputs[self._relative(output_path)] = {"hash": bayseflow_hash, "enriched_at": now,
+                                                         "expires_at": now + expiration_seconds}
+            self.changed = True
+        self.checkpoint()
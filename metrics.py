@@ -0,0 +1,158 @@
+import contextlib
+import json
+import threading
+import time
+
+MAX_UNIQUE_VALUES = 100000  # values remembered per unique count; past this, the count is reported as a lower bound
+LATENCY_BUCKETS_SECONDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+class Metrics:
+    """Collects per-stage wall time, counters, unique-value counts, and latency histograms from every part of a run.
+       All methods are thread-safe. Stage times are summed across threads, so a stage that runs on several threads at
+       once can add up to more than the run's wall-clock time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.stages = dict()  # name -> {"calls": int, "seconds": float}
+            self.counters = dict()
+            self.uniques = dict()  # name -> set of values seen
+            self.histograms = dict()  # name -> {"counts": [one per bucket, plus overflow], "count", "sum", "max"}
+
+    def add_stage_time(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the body of a `with` block as one call of the named stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def track_unique(self, name, value):
+        """Counts a value towards the named unique count. Only the first MAX_UNIQUE_VALUES distinct values are kept,
+           so that a long-running process (e.g. watch mode) doesn't hold on to every value it has ever seen.
+        """
+        with self.lock:
+            values = self.uniques.setdefault(name, set())
+            if len(values) < MAX_UNIQUE_VALUES:
+                values.add(value)
+
+    def observe(self, name, seconds):
+        """Records one latency sample in the named histogram.
+        """
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {"counts": [0] * (len(LATENCY_BUCKETS_SECONDS) + 1),
+                                                          "count": 0, "sum": 0.0, "max": 0.0})
+            bucket = 0
+            while bucket < len(LATENCY_BUCKETS_SECONDS) and seconds > LATENCY_BUCKETS_SECONDS[bucket]:
+                bucket += 1
+            histogram["counts"][bucket] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+
+    @staticmethod
+    def _percentile(histogram, fraction):
+        """Estimates a percentile as the upper bound of the bucket it falls in.
+        """
+        target = fraction * histogram["count"]
+        seen = 0
+        for bucket, count in enumerate(histogram["counts"]):
+            seen += count
+            if seen >= target and count:
+                return LATENCY_BUCKETS_SECONDS[bucket] if bucket < len(LATENCY_BUCKETS_SECONDS) else histogram["max"]
+        return histogram["max"]
+
+    def snapshot(self):
+        """Returns everything collected so far as a JSON-serializable dictionary.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            lookups = counters.get("kb_cache_hits", 0) + counters.get("kb_cache_misses", 0)
+            histograms = dict()
+            for name, histogram in self.histograms.items():
+                histograms[name] = {"count": histogram["count"],
+                                    "mean": histogram["sum"] / histogram["count"] if histogram["count"] else 0.0,
+                                    "p50": self._percentile(histogram, 0.5),
+                                    "p90": self._percentile(histogram, 0.9),
+                                    "p99": self._percentile(histogram, 0.99),
+                                    "max": histogram["max"],
+                                    "buckets": LATENCY_BUCKETS_SECONDS,
+                                    "bucket_counts": list(histogram["counts"])
+                                    }
+            return {"elapsed_seconds": time.perf_counter() - self.started,
+                    "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                    "counters": counters,
+                    "unique": {name: len(values) for name, values in self.uniques.items()},
+                    "kb_cache_hit_ratio": counters.get("kb_cache_hits", 0) / lookups if lookups else None,
+                    "latency_seconds": histograms
+                    }
+
+    def report(self):
+        """Returns a human-readable summary of everything collected so far.
+        """
+        data = self.snapshot()
+        lines = [f"{'=' * 30} Timing report ({data['elapsed_seconds']:0.1f}s elapsed) {'=' * 30}"]
+        if data["stages"]:
+            lines += ["Stages (wall time summed across threads):"]
+            for name, stage in sorted(data["stages"].items(), key=lambda item: -item[1]["seconds"]):
+                lines += [f"  {name:<32}{stage['calls']:>10} calls{stage['seconds']:>12.3f}s"]
+        if data["counters"] or data["unique"]:
+            lines += ["Counts:"]
+            for name, value in sorted(data["counters"].items()):
+                lines += [f"  {name:<32}{value:>16}"]
+            for name, value in sorted(data["unique"].items()):
+                count = f"{value}+" if value >= MAX_UNIQUE_VALUES else str(value)
+                lines += [f"  {'unique_' + name:<32}{count:>16}"]
+        if data["kb_cache_hit_ratio"] is not None:
+            lines += [f"Destination KB cache hit ratio: {data['kb_cache_hit_ratio']:0.1%}"]
+        if data["latency_seconds"]:
+            lines += ["Latency (p50/p90/p99 are bucket upper bounds):"]
+            for name, histogram in sorted(data["latency_seconds"].items()):
+                lines += [f"  {name:<32}n={histogram['count']} mean={histogram['mean']:0.3f}s "
+                          f"p50={histogram['p50']:0.3f}s p90={histogram['p90']:0.3f}s p99={histogram['p99']:0.3f}s "
+                          f"max={histogram['max']:0.3f}s"]
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+METRICS = Metrics()  # shared by every part of the run
+
+
+def stage(name):
+    return METRICS.stage(name)
+
+
+def add_stage_time(name, seconds):
+    METRICS.add_stage_time(name, seconds)
+
+
+def increment(name, amount=1):
+    METRICS.increment(name, amount)
+
+
+def track_unique(name, value):
+    METRICS.track_unique(name, value)
+
+
+def observe(name, seconds):
+    METRICS.observe(name, seconds)
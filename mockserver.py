@@ -0,0 +1,289 @@
+"""A local stand-in for the Bayse API so that enrichment and interpret can be exercised offline. It answers single
+   and batch Destination Knowledgebase queries and interpret requests with fabricated (but realistically shaped) data,
+   and can inject latency, transient errors, and partial batch failures.
+
+   To point the demo at it, run `python3 mockserver.py --port 8080` and then set `BAYSE_API_ENDPOINT` to
+   `http://127.0.0.1:8080` before running `demo.py`.
+"""
+import argparse
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import uuid
+
+# a 1x1 PNG, returned as the screenshot for every interpret request
+SCREENSHOT_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6k"
+                                  "gAAAABJRU5ErkJggg==")
+
+
+def make_kb_data(name, protocol, port):
+    """Fabricates Destination KB data for a destination, shaped like the body of a real /destinations response.
+    """
+    nameport = f"{name}_{protocol}/{port}" if port is not None else f"{name}_{protocol}"
+    parent = name.split(".", 1)[-1] if "." in name else None
+    return {
+        "destination_info": {
+            "knowledge": {nameport: {"destination_data": nameport, "name": name, "protocol_name": protocol,
+                                     "port": port, "owner_groups": [], "landscape": [], "concern_level": 1,
+                                     "category": "Mock Category", "title": "Mock Knowledge", "tags": []}},
+            "statistics": {"name": name, "first_observed": 1606423152.103841, "last_observed": 1669826877.2531362,
+                           "count": len(name), "observed_direct_parent": parent},
+            "flow_summary": {nameport: {"destination_data": nameport, "labels_observed": ["noPayloadData"]}}
+        },
+        "parent_info": {}
+    }
+
+
+def make_interpret_result(url, screenshot=False, all_dest_details=False, screenshot_bytes=0):
+    """Fabricates the results of interpreting a URL, shaped like what a real download link points to. The screenshot
+       is padded out to `screenshot_bytes` so that large results can be exercised.
+    """
+    name = urlparse(url).hostname or url
+    results = [{"type": "interpretation", "message": f"Interpretation of {url}",
+                "interpretation": {"url": url, "summary": "Mock interpretation", "destinations_contacted": 1}},
+               {"type": "knowledge", "message": f"Knowledge about {name}",
+                "knowledge": make_kb_data(name, "TCP", 443)["destination_info"]["knowledge"]}]
+    if all_dest_details:
+        results += [{"type": "all_destination_details", "message": f"Destinations seen while visiting {url}",
+                     "all_destination_details": [make_kb_data(f"cdn{index}.{name}", "TCP", 443)
+                                                 for index in range(20)]}]
+    if screenshot:
+        png = SCREENSHOT_PNG + bytes(max(0, screenshot_bytes - len(SCREENSHOT_PNG)))
+        results += [{"type": "screenshot", "message": f"Screenshot of {url}",
+                     "screenshot": base64.b64encode(png).decode("ascii")}]
+    return {"results": results}
+
+
+class MockBayseServer:
+    """Runs the mock API on a background thread. `latency` is added to every request, `error_rate` is the chance that
+       a request fails with a 503, `partial_rate` is the chance that any one entry is left out of a batch response,
+       and `unknown_rate` is the chance that a destination has no KB data. Set `batch_supported` to False to mimic a
+       server without the batch endpoint. Interpret requests complete `interpret_seconds` after they are submitted,
+       unless they fail (with a chance of `interpret_failure_rate`), and their screenshots are `screenshot_bytes` long.
+       If `rate_limit` is set, requests beyond that many in any one second are refused with a 429 and a Retry-After.
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, partial_rate=0.0, unknown_rate=0.0,
+                 batch_supported=True, interpret_seconds=2.0, interpret_failure_rate=0.0, screenshot_bytes=0,
+                 rate_limit=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.partial_rate = partial_rate
+        self.unknown_rate = unknown_rate
+        self.batch_supported = batch_supported
+        self.interpret_seconds = interpret_seconds
+        self.interpret_failure_rate = interpret_failure_rate
+        self.screenshot_bytes = screenshot_bytes
+        self.rate_limit = rate_limit
+        self.rate_window = (0, 0)  # (second, requests accepted during it)
+        self.interpret_requests = dict()  # request ID -> {"url", "screenshot", "ready_at", "failed"}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"single": 0, "batch": 0, "errors": 0, "throttled": 0, "interpret_submit": 0,
+                       "interpret_status": 0, "interpret_download": 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _chance(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _throttle(self):
+        """Returns True if a request goes over the rate limit."""
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            second = int(time.time())
+            window, accepted = self.rate_window
+            if window != second:
+                window, accepted = second, 0
+            if accepted >= self.rate_limit:
+                self.counts["throttled"] += 1
+                return True
+            self.rate_window = (window, accepted + 1)
+            return False
+
+    def _lookup(self, name, protocol, port):
+        if self._chance(self.unknown_rate):
+            return None
+        return make_kb_data(name, protocol, port)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive like the real API
+            disable_nagle_algorithm = True
+            wbufsize = -1  # send headers and body together
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, data, headers=None):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def begin(self):
+                """Applies latency and error injection. Returns False if the request should fail."""
+                if server.latency:
+                    time.sleep(server.latency)
+                if server._throttle():
+                    self.send_json(429, {"message": "Too Many Requests"}, {"Retry-After": "1"})
+                    return False
+                if server._chance(server.error_rate):
+                    server._count("errors")
+                    self.send_json(503, {"message": "Service Unavailable"})
+                    return False
+                return True
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if parsed.path == "/site/interpret/status":
+                    self.interpret_status(parse_qs(parsed.query).get("request_id", [""])[0])
+                    return
+                if parsed.path.startswith("/site/interpret/results/"):
+                    self.interpret_download(parsed.path.rsplit("/", 1)[-1])
+                    return
+                if parsed.path != "/destinations":
+                    self.send_json(404, {"message": "Not Found"})
+                    return
+                if not self.begin():
+                    return
+                server._count("single")
+                query = parse_qs(parsed.query)
+                port = int(query["port"][0]) if "port" in query else None
+                kb_data = server._lookup(query["name"][0], query["protocol"][0], port)
+                if kb_data is None:
+                    self.send_json(404, {"message": "Unknown destination"})
+                else:
+                    self.send_json(200, {"body": kb_data})
+
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                if parsed.path == "/site/interpret/request":
+                    self.interpret_submit(payload)
+                    return
+                if parsed.path != "/destinations/batch" or not server.batch_supported:
+                    self.send_json(404, {"message": "Not Found"})
+                    return
+                if not self.begin():
+                    return
+                server._count("batch")
+                results = []
+                for destination in payload.get("destinations", []):
+                    if server._chance(server.partial_rate):
+                        continue
+                    name, protocol, port = destination["name"], destination["protocol"], destination.get("port")
+                    results += [{"name": name, "protocol": protocol, "port": port,
+                                 "body": server._lookup(name, protocol, port)}]
+                self.send_json(200, {"body": {"results": results}})
+
+            def interpret_submit(self, payload):
+                if not self.begin():
+                    return
+                server._count("interpret_submit")
+                request_id = uuid.uuid4().hex
+                with server.lock:
+                    server.interpret_requests[request_id] = {
+                        "url": payload.get("url"), "screenshot": payload.get("getScreenshot", False),
+                        "details": payload.get("allDestinationDetails", False),
+                        "ready_at": time.monotonic() + server.interpret_seconds,
+                        "failed": server.interpret_failure_rate > 0 and
+                        server.random.random() < server.interpret_failure_rate}
+                self.send_json(200, {"request_id": request_id})
+
+            def interpret_status(self, request_id):
+                if not self.begin():
+                    return
+                server._count("interpret_status")
+                with server.lock:
+                    request = server.interpret_requests.get(request_id)
+                if request is None:
+                    self.send_json(404, {"message": "Unknown request"})
+                elif time.monotonic() < request["ready_at"]:
+                    self.send_json(200, {"status": "In Progress"})
+                elif request["failed"]:
+                    self.send_json(200, {"status": "Failed"})
+                else:
+                    self.send_json(200, {"status": "Complete",
+                                         "download_link": f"{server.url}/site/interpret/results/{request_id}"})
+
+            def interpret_download(self, request_id):
+                if not self.begin():
+                    return
+                server._count("interpret_download")
+                with server.lock:
+                    request = server.interpret_requests.get(request_id)
+                if request is None or request["failed"] or time.monotonic() < request["ready_at"]:
+                    self.send_json(404, {"message": "Not Found"})
+                else:
+                    self.send_json(200, make_interpret_result(request["url"], request["screenshot"], request["details"],
+                                                              server.screenshot_bytes))
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="port to listen on", type=int, default=8080)
+    parser.add_argument("--latency", help="seconds of latency added to every request", type=float, default=0.0)
+    parser.add_argument("--errorrate", help="fraction of requests that fail with a 503", type=float, default=0.0)
+    parser.add_argument("--partialrate", help="fraction of batch entries left out of responses", type=float,
+                        default=0.0)
+    parser.add_argument("--unknownrate", help="fraction of destinations with no KB data", type=float, default=0.0)
+    parser.add_argument("--nobatch", help="behave like a server without the batch endpoint", action="store_true")
+    parser.add_argument("--interpretseconds", help="seconds an interpret request takes to complete", type=float,
+                        default=2.0)
+    parser.add_argument("--interpretfailurerate", help="fraction of interpret requests that fail", type=float,
+                        default=0.0)
+    parser.add_argument("--screenshotbytes", help="size that interpret screenshots are padded out to", type=int,
+                        default=0)
+    parser.add_argument("--ratelimit", help="most requests accepted per second before answering with a 429",
+                        type=int, default=0)
+    args = parser.parse_args()
+    mock = MockBayseServer(port=args.port, latency=args.latency, error_rate=args.errorrate,
+                           partial_rate=args.partialrate, unknown_rate=args.unknownrate,
+                           batch_supported=not args.nobatch, interpret_seconds=args.interpretseconds,
+                           interpret_failure_rate=args.interpretfailurerate, screenshot_bytes=args.screenshotbytes,
+                           rate_limit=args.ratelimit)
+    print(f"Mock Bayse API listening at {mock.url}")
+    try:
+        mock.httpd.serve_forever()
+    except KeyboardInterrupt:
+        mock.httpd.server_close()
@@ -0,0 +1,89 @@
+"""JSON encoding/decoding and (optionally compressed) BayseFlow file access shared by everything that reads or writes
+   BayseFlow files, cached Destination KB data, and the manifest.
+
+   If orjson is installed it is used to encode and decode whole values, since it is several times faster than the
+   standard library; otherwise the json module is used, so output is exactly what it was before. Files whose names end
+   in `.gz` are read and written with gzip, and files whose names end in `.zst` with Zstandard (which needs the
+   zstandard package).
+"""
+import gzip
+import io
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BACKEND = "orjson" if orjson else "json"
+COMPRESSION_SUFFIXES = {"gz": ".gz", "zst": ".zst"}
+BAYSEFLOW_SUFFIXES = (".bf", ".bf.gz", ".bf.zst")
+GZIP_COMPRESSION_LEVEL = 6  # most of gzip's benefit at a fraction of the cost of level 9
+ZSTD_COMPRESSION_LEVEL = 3
+
+
+def dumps(value):
+    """Encodes a value as a JSON string.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:  # e.g. integers beyond 64 bits or non-string keys, which only json handles
+            pass
+    return json.dumps(value)
+
+
+def loads(data):
+    """Decodes a JSON string (or UTF-8 bytes).
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:  # e.g. NaN or Infinity, which only json accepts
+            pass
+    return json.loads(data)
+
+
+def is_bayseflow_file(name):
+    return str(name).endswith(BAYSEFLOW_SUFFIXES)
+
+
+def get_compression(name):
+    """Returns the compression used by a file based on its name ("gz", "zst", or None).
+    """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if str(name).endswith(suffix):
+            return compression
+    return None
+
+
+def check_compression(compression):
+    """Raises a RuntimeError if a compression isn't supported by the packages that are installed.
+    """
+    if compression not in (None, *COMPRESSION_SUFFIXES):
+        raise RuntimeError(f"Unknown compression {compression}")
+    if compression == "zst" and zstandard is None:
+        raise RuntimeError("Reading and writing .zst files needs the zstandard package (pip3 install zstandard)")
+
+
+def open_text(name, mode="r"):
+    """Opens a file as UTF-8 text (mode "r" or "w"), transparently (de)compressing it if its name says it is
+       compressed.
+    """
+    compression = get_compression(name)
+    check_compression(compression)
+    if compression == "gz":
+        return gzip.open(name, f"{mode}t", encoding="utf-8", compresslevel=GZIP_COMPRESSION_LEVEL)
+    if compression == "zst":
+        fileobj = open(name, f"{mode}b")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=ZSTD_COMPRESSION_LEVEL).stream_writer(fileobj, closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(name, mode, encoding="utf-8")
@@ -0,0 +1,196 @@
+"""Watches a directory tree for inputs (Zeek logs and PCAPs) that are new or have changed, and reports the directories
+   holding them once every changed input in the directory has been fully written.
+
+   If the inotify_simple package is installed (Linux only), the kernel tells us about changes as they happen.
+   Otherwise the tree is polled: each poll only lists directories whose mtime changed (i.e. files were added, removed,
+   or renamed), with a full rescan every FULL_RESCAN_SECONDS to catch inputs rewritten in place. Either way, an input
+   only counts as written once it hasn't been modified for `settle_seconds`, since sensors may still be appending to a
+   file when we first hear about it.
+"""
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+SETTLE_SECONDS = 5.0  # how long an input must go unmodified before it's considered fully written
+POLL_INTERVAL_SECONDS = 2.0  # how often the tree is checked for changes when polling (and unsettled inputs re-checked)
+FULL_RESCAN_SECONDS = 300.0  # how often polling relists every directory, not just the ones whose mtime changed
+
+
+def get_inotify_mask():
+    flags = inotify_simple.flags
+    return flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE_SELF | flags.MOVE_SELF
+
+
+class InputWatcher:
+    """Watches `root` (recursively, skipping any of the `exclude` directories and hidden ones) for files that
+       `is_input(name)` accepts. Call wait() to block until some directories are ready; a directory is ready once an
+       input in it has changed since it was last reported and every changed input in it has settled.
+    """
+    def __init__(self, root, is_input, exclude=(), settle_seconds=SETTLE_SECONDS,
+                 poll_seconds=POLL_INTERVAL_SECONDS, use_inotify=None):
+        self.root = os.path.abspath(root)
+        self.is_input = is_input
+        self.exclude = {os.path.abspath(directory) for directory in exclude}
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self.directories = dict()  # directory -> mtime_ns when it was last listed
+        self.reported = dict()  # directory -> {input: (size, mtime_ns) when the directory was last reported ready}
+        self.unsettled = dict()  # input -> directory, for inputs that changed but may still be being written
+        self.settled = set()  # directories with settled changes that are waiting on other inputs in them to settle
+        self.last_full_scan = 0.0
+        self.inotify = None
+        self.watches = dict()  # inotify watch descriptor -> directory
+        self.watched = dict()  # directory -> inotify watch descriptor
+        if use_inotify is None:
+            use_inotify = inotify_simple is not None
+        if use_inotify:
+            try:
+                self.inotify = inotify_simple.INotify()
+            except (AttributeError, OSError) as e:  # e.g. not Linux, or out of inotify instances
+                print(f"Can't use inotify ({e}). Polling for changes instead.")
+        self.scan(self.root)
+        self.last_full_scan = time.monotonic()
+
+    @property
+    def mode(self):
+        return "inotify" if self.inotify else "polling"
+
+    def _is_excluded(self, directory):
+        return directory in self.exclude or os.path.basename(directory).startswith(".")
+
+    def scan(self, directory, recursive=False):
+        """Lists a directory, noting every input that is new or has changed since the directory was last reported, and
+           then does the same for any subdirectories it hasn't seen before (or for every subdirectory, if `recursive`).
+        """
+        pending = [directory]
+        while pending:
+            directory = pending.pop()
+            if self._is_excluded(directory) and directory != self.root:
+                continue
+            try:
+                self.directories[directory] = os.stat(directory).st_mtime_ns
+                if self.inotify and directory not in self.watched:
+                    wd = self.inotify.add_watch(directory, get_inotify_mask())
+                    self.watches[wd] = directory
+                    self.watched[directory] = wd
+                inputs = set()
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive or os.path.abspath(entry.path) not in self.directories:
+                                pending += [os.path.abspath(entry.path)]
+                        elif entry.is_file() and self.is_input(entry.name):
+                            inputs.add(os.path.abspath(entry.path))
+                            self.note_change(os.path.abspath(entry.path), directory, entry.stat())
+                reported = self.reported.get(directory, dict())
+                for path in set(reported).difference(inputs):  # inputs that have since been removed
+                    del reported[path]
+            except OSError as e:
+                self.forget_directory(directory)
+                if os.path.isdir(directory):
+                    print(f"Failed to scan {directory}: {e}")
+
+    def forget_directory(self, directory):
+        self.directories.pop(directory, None)
+        self.reported.pop(directory, None)
+        wd = self.watched.pop(directory, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+
+    def note_change(self, path, directory, stat=None):
+        """Marks an input as unsettled unless it's exactly as it was when its directory was last reported.
+        """
+        try:
+            stat = stat or os.stat(path)
+        except OSError:  # it's already gone again
+            self.unsettled.pop(path, None)
+            return
+        if self.reported.get(directory, dict()).get(path) != (stat.st_size, stat.st_mtime_ns):
+            self.unsettled[path] = directory
+
+    def poll(self):
+        """Finds changes by relisting the directories whose mtime changed (or every directory, now and then).
+        """
+        full_scan = time.monotonic() - self.last_full_scan >= FULL_RESCAN_SECONDS
+        if full_scan:
+            self.last_full_scan = time.monotonic()
+        for directory, mtime_ns in list(self.directories.items()):
+            try:
+                changed = full_scan or os.stat(directory).st_mtime_ns != mtime_ns
+            except OSError:
+                self.forget_directory(directory)
+                continue
+            if changed:
+                self.scan(directory)
+
+    def read_events(self, timeout):
+        """Waits up to `timeout` seconds for inotify events and notes the changes they describe.
+        """
+        flags = inotify_simple.flags
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:  # the kernel dropped events, so we don't know what changed
+                print("Missed some file system events. Rescanning every directory.")
+                self.scan(self.root, recursive=True)
+                continue
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & (flags.DELETE_SELF | flags.MOVE_SELF | flags.IGNORED):
+                self.forget_directory(directory)
+            elif event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self.scan(os.path.join(directory, event.name))  # files may have landed before it was watched
+            elif self.is_input(event.name) and os.path.join(directory, event.name) not in self.unsettled:
+                self.note_change(os.path.join(directory, event.name), directory)
+
+    def check_settled(self):
+        """Moves inputs that haven't been modified for `settle_seconds` out of `unsettled`, and returns the
+           directories that are now ready. Returns how long until the next unsettled input could settle, too.
+        """
+        now = time.time()
+        next_check = self.poll_seconds
+        for path, directory in list(self.unsettled.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.unsettled[path]
+                continue
+            quiet = now - stat.st_mtime_ns / 1e9
+            if quiet >= self.settle_seconds:
+                del self.unsettled[path]
+                self.reported.setdefault(directory, dict())[path] = (stat.st_size, stat.st_mtime_ns)
+                self.settled.add(directory)
+            else:
+                next_check = min(next_check, self.settle_seconds - quiet)
+        busy = set(self.unsettled.values())
+        ready = self.settled - busy
+        self.settled &= busy
+        return ready, max(next_check, 0.05)
+
+    def wait(self, timeout=None):
+        """Blocks until some directories are ready (or `timeout` seconds pass) and returns them as a sorted list.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            ready, next_check = self.check_settled()
+            if ready:
+                return sorted(ready)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                next_check = min(next_check, remaining)
+            if self.inotify:
+                self.read_events(next_check)
+            else:
+                time.sleep(next_check)
+                self.poll()
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None